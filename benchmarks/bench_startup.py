@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Measure how long sushichef.py takes to start up.
+
+Each case runs in a fresh interpreter, so module imports are timed cold:
+  - import: `import sushichef` (what every run pays before scraping starts)
+  - help: `./sushichef.py -h` (argument parsing only)
+
+Usage: python benchmarks/bench_startup.py [--runs N] [--importtime]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+CASES = {
+    "import": [sys.executable, "-c", "import sushichef"],
+    "help": [sys.executable, os.path.join(ROOT, "sushichef.py"), "-h"],
+}
+
+
+def time_case(command, runs, env):
+    """ Run command `runs` times and return how many seconds each run took ([float]) """
+    timings = []
+    for _run in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, env=env, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def print_slowest_imports(env, count=15):
+    """ Print the modules that take longest to import (cumulative), using python -X importtime """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import sushichef"],
+                            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    imports = []
+    for line in result.stderr.decode('utf-8').splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            imports.append((int(parts[1]), parts[2].strip()))
+    print("\nSlowest imports (cumulative):")
+    for microseconds, module in sorted(imports, reverse=True)[:count]:
+        print("    {:8.1f} ms  {}".format(microseconds / 1000, module))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure sushichef.py startup time")
+    parser.add_argument('--runs', type=int, default=10, help="Number of runs per case (default 10)")
+    parser.add_argument('--importtime', action='store_true', help="Also list the slowest imports")
+    args = parser.parse_args()
+
+    # Point output at a scratch directory so the benchmark can't touch a real run's files
+    with tempfile.TemporaryDirectory() as output_dir:
+        env = dict(os.environ, EXPLORATORIUM_OUTPUT_DIR=output_dir)
+        for name, command in CASES.items():
+            timings = time_case(command, args.runs, env)
+            print("{:8} median {:7.1f} ms   min {:7.1f} ms   max {:7.1f} ms   ({} runs)".format(
+                name, statistics.median(timings) * 1000, min(timings) * 1000, max(timings) * 1000, args.runs))
+        if args.importtime:
+            print_slowest_imports(env)
+        if os.listdir(output_dir):
+            print("\nWarning: startup wrote to the output directory: {}".format(", ".join(os.listdir(output_dir))))
+
+
+if __name__ == '__main__':
+    main()
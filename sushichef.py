@@ -1,6 +1,25 @@
 #!/usr/bin/env python
+import contextlib
+import functools
+import hashlib
+import heapq
+import importlib
+import json
+import multiprocessing
 import os
+import queue
+import re
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import zipfile
+import zlib
+from ricecooker import config
 from ricecooker.utils import downloader, html_writer
 from ricecooker.chefs import SushiChef
 from ricecooker.classes import nodes, files, questions
@@ -8,15 +27,48 @@ from ricecooker.config import LOGGER              # Use LOGGER to print messages
 from ricecooker.exceptions import raise_for_invalid_channel
 from le_utils.constants import exercises, content_kinds, file_formats, format_presets, languages, licenses
 
-import cssutils
 import requests
-import youtube_dl
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait as wait_for_futures
 from io import BytesIO
 from PIL import Image
+from urllib.parse import urljoin, urlparse, parse_qs
+
+try:
+    import fcntl    # Used to lock downloads across snack worker processes (not available on Windows)
+except ImportError:
+    fcntl = None
 
 import logging
-cssutils.log.setLevel(logging.CRITICAL)
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a heavy module that imports it the first time one of its attributes is used,
+    so runs (and `./sushichef.py -h`) only pay for the subsystems their stages actually reach.
+    Only worth it for modules ricecooker doesn't already import (bs4, PIL and ricecooker's
+    downloader come in with ricecooker.chefs anyway).
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, name, setup=None):
+        super(LazyModule, self).__init__(name)
+        self._setup = setup     # Function to configure the module with once it's imported (optional)
+
+    def __getattr__(self, attr):
+        # Only called for attributes not copied over yet, i.e. before the module is loaded
+        with LazyModule._lock:
+            if '_module' not in self.__dict__:
+                module = importlib.import_module(self.__name__)
+                self._setup and self._setup(module)
+                for name, value in module.__dict__.items():
+                    self.__dict__.setdefault(name, value)  # Keep anything already set on the stand-in
+                self.__dict__['_module'] = module
+        return getattr(self.__dict__['_module'], attr)
+
+
+cssutils = LazyModule('cssutils', setup=lambda module: module.log.setLevel(logging.CRITICAL))
+youtube_dl = LazyModule('youtube_dl')
 
 
 # Run constants
@@ -44,22 +96,86 @@ VIDEO_URL = "https://www.exploratorium.edu/video/subjects"
 BRIGHTCOVE_URL = "http://players.brightcove.net/{account}/{player}_default/index.html?videoId={videoid}"
 IMAGE_EXTENSIONS = ['jpeg', 'jpg', 'gif', 'png', 'svg']
 DOWNLOAD_ATTEMPTS = 25
+VIDEO_FORMAT = "bestvideo[height<=480][ext=mp4]+bestaudio[ext=m4a]/best[height<=480][ext=mp4]"  # Used if formats aren't listed
+MAX_VIDEO_HEIGHT = 480              # Tallest video format to download
+VIDEO_INFO_TTL = 6 * 60 * 60        # Seconds to trust a cached media url that doesn't state its own expiry
+MEDIA_CHUNK_SIZE = 1024 * 1024      # Bytes to stream at a time when downloading media
+ASSET_WORKERS = 8                   # Number of assets to fetch at a time for each snack
+DOWNLOAD_RATE = 2 * 1024 * 1024     # Bytes per second each download slot is assumed to get, to predict finish times
+PIPELINE_QUEUE_SIZE = 16            # Number of fetched snack pages that can wait to be zipped
+TRANSCODE_WORKERS = os.cpu_count() or 1     # Number of ffmpeg processes to re-encode videos with at a time
+TRANSCODE_SETTINGS = {              # ffmpeg settings to re-encode videos with (when enabled)
+    "height": 360,                  # Scale taller videos down to this height
+    "crf": 30,                      # H.264 constant rate factor (higher is smaller)
+    "preset": "medium",
+    "audio_bitrate": "64k",
+}
+
+# Tokens that can hold url references in stylesheets. Comments and strings are matched
+# so references inside them are skipped, and anything unterminated is flagged as an error.
+CSS_STRING = r'"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\''
+CSS_TOKEN_RE = re.compile(r'''
+    /\*.*?\*/
+  | (?<![\w-])url\(\s*(?P<url>{string}|[^"'()\s]*)\s*\)
+  | @import\s+(?P<import>{string})
+  | {string}
+  | (?P<error>/\*|(?<![\w-])url\(|["'])
+'''.format(string=CSS_STRING), re.DOTALL | re.IGNORECASE | re.VERBOSE)
+
+# Environment variable to write output (snacks, videos and caches) somewhere other than next to this script
+OUTPUT_DIRECTORY_ENV = "EXPLORATORIUM_OUTPUT_DIR"
+
+
+def set_output_directory(root):
+    """ Point every output directory and cache file under root (see `make_output_directories`)
+        Args:
+            root (str): directory to write output under
+    """
+    global SNACK_DIRECTORY, SHARED_ASSET_DIRECTORY, VIDEO_DIRECTORY, VIDEO_INFO_PATH, TRANSCODE_DIRECTORY, \
+        TRANSCODE_REPORT_PATH, VIDEO_BUDGET_PATH, CHECKSUM_INDEX_PATH, CACHE_USAGE_PATH, TREE_CACHE_PATH, PROFILE_DIRECTORY
+
+    # Directory to download snacks (html zips) into
+    SNACK_DIRECTORY = os.path.sep.join([root, "snacks"])
 
-# Directory to download snacks (html zips) into
-SNACK_DIRECTORY = "{}{}{}".format(os.path.dirname(os.path.realpath(__file__)), os.path.sep, "snacks")
-if not os.path.exists(SNACK_DIRECTORY):
-    os.makedirs(SNACK_DIRECTORY)
+    # Directory to download shared assets (e.g. pngs, gifs, svgs) from stylesheets into
+    SHARED_ASSET_DIRECTORY = os.path.sep.join([SNACK_DIRECTORY, "shared-assets"])
 
-# Directory to download videos into
-VIDEO_DIRECTORY = "{}{}{}".format(os.path.dirname(os.path.realpath(__file__)), os.path.sep, "videos")
-if not os.path.exists(VIDEO_DIRECTORY):
-    os.makedirs(VIDEO_DIRECTORY)
+    # Directory to download videos into
+    VIDEO_DIRECTORY = os.path.sep.join([root, "videos"])
 
-# Directory to download shared assets (e.g. pngs, gifs, svgs) from stylesheets into
-SHARED_ASSET_DIRECTORY = os.path.sep.join([SNACK_DIRECTORY, "shared-assets"])
-if not os.path.exists(SHARED_ASSET_DIRECTORY):
-    os.makedirs(SHARED_ASSET_DIRECTORY)
+    # File to cache extracted video info (chosen format, media url, size, expiry) in
+    VIDEO_INFO_PATH = os.path.sep.join([VIDEO_DIRECTORY, "video-info.json"])
 
+    # Directory to cache re-encoded videos in (by source checksum and encode settings)
+    TRANSCODE_DIRECTORY = os.path.sep.join([VIDEO_DIRECTORY, "transcoded"])
+
+    # File to log how many bytes re-encoding saved on each video this run in (across snack workers)
+    TRANSCODE_REPORT_PATH = os.path.sep.join([VIDEO_DIRECTORY, "transcode-report.jsonl"])
+
+    # File to share the video byte budgets and the bytes each video takes up this run in (across snack workers)
+    VIDEO_BUDGET_PATH = os.path.sep.join([VIDEO_DIRECTORY, "video-budget.json"])
+
+    # File to record checksums of zips and videos in as they are written, so uploading doesn't rehash them
+    CHECKSUM_INDEX_PATH = os.path.sep.join([root, "checksums.jsonl"])
+
+    # File to log which run last used each cached snack, asset and video in, for evicting the least recently used
+    CACHE_USAGE_PATH = os.path.sep.join([root, "cache-usage.jsonl"])
+
+    # File to save the scraped tree in, so unchanged subjects and collections can be reused next run
+    TREE_CACHE_PATH = os.path.sep.join([root, "tree-cache.json"])
+
+    # Directory to write profiling output (flame graph stacks) into
+    PROFILE_DIRECTORY = os.path.sep.join([root, "profiles"])
+
+
+def make_output_directories():
+    """ Create the output directories (when a run starts rather than on import, so `-h` writes nothing) """
+    for directory in (SNACK_DIRECTORY, SHARED_ASSET_DIRECTORY, VIDEO_DIRECTORY, TRANSCODE_DIRECTORY):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+
+set_output_directory(os.environ.get(OUTPUT_DIRECTORY_ENV) or os.path.dirname(os.path.realpath(__file__)))
 
 # The chef subclass
 ################################################################################
@@ -88,6 +204,45 @@ class MyChef(SushiChef):
     # pre_run: to perform preliminary tasks, e.g., crawling and scraping website
     # __init__: if need to customize functionality or add command line arguments
 
+    def __init__(self, *args, **kwargs):
+        super(MyChef, self).__init__(*args, **kwargs)
+        self.arg_parser.add_argument('--output-dir', metavar='DIR',
+                                     help='Directory to write snacks, videos and caches under (default: ${} '
+                                          'or next to this script)'.format(OUTPUT_DIRECTORY_ENV))
+        self.arg_parser.add_argument('--trace-memory', action='store_true',
+                                     help='Report peak memory used by each scraping stage')
+        self.arg_parser.add_argument('--profile', action='store_true',
+                                     help='Sample stacks while scraping and write flame graph data by stage')
+        self.arg_parser.add_argument('--profile-interval', type=float, default=0.01,
+                                     help='Seconds between stack samples when profiling')
+        self.arg_parser.add_argument('--fetch-workers', type=int, default=4,
+                                     help='Number of threads fetching snack pages')
+        self.arg_parser.add_argument('--snack-workers', type=int, default=0,
+                                     help='Number of processes parsing and zipping snacks (0 to zip in the main process)')
+        self.arg_parser.add_argument('--download-workers', type=int, default=4,
+                                     help='Number of videos to download at a time for the videos tree (largest first)')
+        archive_group = self.arg_parser.add_mutually_exclusive_group()
+        archive_group.add_argument('--record', metavar='ARCHIVE',
+                                   help='Record every page, asset and video fetched to an archive file')
+        archive_group.add_argument('--replay', metavar='ARCHIVE',
+                                   help='Serve every page, asset and video from a recorded archive (no network)')
+        self.arg_parser.add_argument('--split-playlists', action='store_true',
+                                     help='Add brightcove playlist videos as video nodes next to their activity '
+                                          'instead of embedding them in its zip')
+        self.arg_parser.add_argument('--transcode', action='store_true',
+                                     help='Re-encode downloaded videos at a lower bitrate with ffmpeg (on every core)')
+        self.arg_parser.add_argument('--transcode-crf', type=int, default=TRANSCODE_SETTINGS['crf'],
+                                     help='H.264 quality to re-encode videos at (higher is smaller, default %(default)s)')
+        self.arg_parser.add_argument('--transcode-height', type=int, default=TRANSCODE_SETTINGS['height'],
+                                     help='Height to scale re-encoded videos down to (default %(default)s)')
+        self.arg_parser.add_argument('--video-budget', type=parse_size, metavar='SIZE',
+                                     help='Most disk space each video may take up (e.g. 50M), picking smaller formats to fit')
+        self.arg_parser.add_argument('--channel-budget', type=parse_size, metavar='SIZE',
+                                     help='Most disk space all videos together may take up (e.g. 4G)')
+        self.arg_parser.add_argument('--cache-size', type=parse_size, metavar='SIZE',
+                                     help='Most disk space cached snacks and videos may take up (e.g. 20G), '
+                                          'evicting the files least recently used by a run')
+
     def construct_channel(self, *args, **kwargs):
         """
         Creates ChannelNode and build topic tree
@@ -110,20 +265,66 @@ class MyChef(SushiChef):
         """
         channel = self.get_channel(*args, **kwargs)  # Create ChannelNode from data in self.channel_info
 
-        channel.add_child(scrape_snack_menu(SNACK_URL))
-        channel.add_child(scrape_video_menu(VIDEO_URL))
+        if kwargs.get('output_dir'):
+            set_output_directory(os.path.realpath(kwargs['output_dir']))   # Forked snack workers inherit it
+        make_output_directories()
+
+        if kwargs.get('trace_memory'):
+            tracemalloc.start()
+        profiler = kwargs.get('profile') and StackSampler(kwargs.get('profile_interval') or 0.01)
+        profiler and profiler.start()
+        build_workers = kwargs.get('snack_workers') or 0
+        if build_workers and (kwargs.get('trace_memory') or kwargs.get('profile')):
+            LOGGER.warning("Snacks are zipped in worker processes, so scrape_snack_page won't show up in the "
+                           "memory trace or profile (use --snack-workers 0 to include it)")
+        transcode = kwargs.get('transcode') and dict(TRANSCODE_SETTINGS,
+                                                     crf=kwargs.get('transcode_crf') or TRANSCODE_SETTINGS['crf'],
+                                                     height=kwargs.get('transcode_height') or TRANSCODE_SETTINGS['height'])
+        if kwargs.get('record') or kwargs.get('replay'):
+            open_archive(kwargs.get('record') or kwargs.get('replay'), recording=bool(kwargs.get('record')))
+            if kwargs.get('record') and build_workers:
+                LOGGER.warning("Zipping snacks in the main process so every fetch reaches the archive")
+                build_workers = 0
+
+        try:
+            load_tree_cache(TREE_CACHE_PATH, refresh=config.UPDATE)
+            start_cache_run()
+            if UPLOAD_CHECKSUMS or transcode:
+                start_checksum_index()
+            start_video_budget(kwargs.get('video_budget'), kwargs.get('channel_budget'))
+            start_transcode_report()
+            channel.add_child(scrape_snack_menu(SNACK_URL,
+                                                fetch_workers=kwargs.get('fetch_workers') or 4,
+                                                build_workers=build_workers,
+                                                split_playlists=bool(kwargs.get('split_playlists')),
+                                                transcode=transcode))
+            channel.add_child(scrape_video_menu(VIDEO_URL, download_workers=kwargs.get('download_workers') or 4,
+                                                transcode=transcode))
+            save_tree_cache(TREE_CACHE_PATH)
+            trim_media_cache(kwargs.get('cache_size'))
+            report_video_budget()
+            transcode and report_transcoding()
+        finally:
+            close_archive()
+            if profiler:
+                profiler.stop()
+                profiler.write(PROFILE_DIRECTORY)
+            if tracemalloc.is_tracing():
+                report_stage_peaks()
+                tracemalloc.stop()
 
         raise_for_invalid_channel(channel)  # Check for errors in channel construction
 
         return channel
 
 def read(url):
-    """ Read contents from url
+    """ Read contents from url (through the record/replay archive, if one is open)
         Args:
             url (str): url to read
         Returns contents from url
     """
-    return downloader.read(format_url(url))
+    url = format_url(url)
+    return fetch_archived(url, lambda: downloader.read(url))
 
 
 def format_url(url):
@@ -162,58 +363,261 @@ def get_thumbnail_url(url):
         url = os.path.sep.join([SNACK_DIRECTORY, url.split("/")[-1].replace('gif', 'png')])
         with Image.open(imgfile) as img:
             img.save(url,'png', optimize=True, quality=70)
+        use_cached_file(url)
+
+    # Ricecooker would download other thumbnails itself, so save them through the archive instead
+    # (named by url, as thumbnails of different snacks often share a filename)
+    elif url and ARCHIVE:
+        content = read(url)
+        filename = "thumbnail-{}{}".format(hashlib.sha1(url.encode('utf-8')).hexdigest(),
+                                           os.path.splitext(url.split("/")[-1])[1])
+        url = os.path.sep.join([SNACK_DIRECTORY, filename])
+        fd, temp_path = tempfile.mkstemp(dir=SNACK_DIRECTORY, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as fobj:
+            fobj.write(content)
+        os.replace(temp_path, url)   # Snack worker processes may save the same thumbnail at once
+        use_cached_file(url)
     return url or None
 
 
-def get_brightcove_mapping(contents, get_playlist=False):
-    """ Scrape contents for brightcove videos
+def get_brightcove_account(contents):
+    """ Get the brightcove account of the page's main player (playlist items don't store it)
         Args:
             contents (BeautifulSoup): page contents
-            get_playlist (bool): determines whether or not to scrape for playlists too
-        Returns mapping of brightcove urls and data
+        Returns account number (str), or "" if the page has no main player
     """
-    brightcove_mapping = {}
-    account = "" # Store account number as it isn't stored on playlist video elements
+    player = contents.find('video', {'class': 'bc5player'})
+    return player.get('data-account', "") if player else ""
+
 
-    # Get main videos
+def get_brightcove_videos(contents):
+    """ Scrape contents for brightcove videos
+        Args:
+            contents (BeautifulSoup): page contents
+        Returns list of video records with id, url and author keys ([dict])
+    """
+    brightcove_videos = {}
     for video in contents.find_all('video', {'class': 'bc5player'}):
-        account = video['data-account']
         attribution = contents.find('div', {'class': 'attribution'})
-        brightcove_mapping.update({video['data-video-id']: {
-            "original_el": video,
+        brightcove_videos.update({video['data-video-id']: {
+            "id": video['data-video-id'],
             "author": attribution and attribution.text,
             "url": BRIGHTCOVE_URL.format(account=video['data-account'],
                                         player=video['data-player'],
                                         videoid=video['data-video-id'])
         }})
+    return list(brightcove_videos.values())
+
+
+# Instrumentation functions
+################################################################################
+_stage_lock = threading.Lock()
+_active_stages = {}     # Stage name -> number of calls currently running it
+_stage_peaks = {}       # Stage name -> highest traced memory while running it (bytes)
+_thread_stages = {}     # Thread id -> stack of stages the thread is running
+
+
+@contextlib.contextmanager
+def track_stage(name):
+    """ Track a scraping stage (can also be used as a function decorator)
+        Args:
+            name (str): name of stage (e.g. scrape_snack_page)
+    """
+    stages = _thread_stages.setdefault(threading.get_ident(), [])
+    stages.append(name)
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        with _stage_lock:
+            record_stage_peaks()
+            _active_stages[name] = _active_stages.get(name, 0) + 1
+    try:
+        yield
+    finally:
+        stages.pop()
+        if tracing and tracemalloc.is_tracing():
+            with _stage_lock:
+                record_stage_peaks()
+                _active_stages[name] -= 1
+
+
+def record_stage_peaks():
+    """ Attribute the traced memory peak since the last call to every running stage """
+    _current, peak = tracemalloc.get_traced_memory()
+    for name, running in _active_stages.items():
+        if running:
+            _stage_peaks[name] = max(_stage_peaks.get(name, 0), peak)
+    tracemalloc.reset_peak()
+
+
+def report_stage_peaks():
+    """ Log the peak memory seen during each scraping stage """
+    LOGGER.info("PEAK MEMORY BY STAGE")
+    for name, peak in sorted(_stage_peaks.items(), key=lambda item: -item[1]):
+        LOGGER.info("    {}: {:.1f} MB".format(name, peak / 1024 / 1024))
+
+
+class StackSampler(threading.Thread):
+    """
+    Low-overhead sampling profiler. Every `interval` seconds it records the stack of each
+    other thread under the innermost scraping stage that thread is running (see `track_stage`),
+    so a long run can be profiled without the cost of tracing every call. Threads waiting in
+    Python-level waits (queues, futures, events and conditions, sockets, subprocesses) aren't
+    counted. A plain `Lock.acquire` blocks in C, so a thread stuck on a lock still shows up
+    under the function that took it.
+    """
 
-    # Add videos from brightcove playlists
-    playlist = contents.find('div', {'id': 'media-collection-banner-playlist'})
-    if get_playlist and playlist:
-        for video in playlist.find_all('div', {'class': 'playlist-item'}):
-            brightcove_mapping.update({video['data-id']: {
-                "title": video['data-title'],
-                "append_to": playlist,
-                "url": BRIGHTCOVE_URL.format(account=account,
-                                            player=video['data-pid'],
-                                            videoid=video['data-id']),
-            }})
+    # (file, function) of the innermost frames threads sit in while they're waiting
+    IDLE_FRAMES = {
+        ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"),
+        ("queue.py", "get"), ("queue.py", "put"), ("thread.py", "_worker"),
+        ("_base.py", "result"), ("_base.py", "wait"), ("_base.py", "as_completed"),
+        ("socket.py", "readinto"), ("socket.py", "accept"), ("ssl.py", "read"), ("ssl.py", "recv_into"),
+        ("selectors.py", "select"), ("connection.py", "wait"),
+        ("subprocess.py", "_try_wait"), ("subprocess.py", "_communicate"),
+    }
+
+    def __init__(self, interval):
+        super(StackSampler, self).__init__(name="stack-sampler", daemon=True)
+        self.interval = interval
+        self.samples = {}               # Stage name -> {folded stack: number of samples}
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def sample(self):
+        """ Record the current stack of every other thread """
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self.ident:
+                continue
+            leaf = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+            if leaf in self.IDLE_FRAMES:
+                continue
+            stages = list(_thread_stages.get(thread_id, ()))    # The thread may leave a stage meanwhile
+            stage = stages[-1] if stages else "other"
+            stack = []
+            while frame:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            folded = ";".join(reversed(stack))
+            counts = self.samples.setdefault(stage, {})
+            counts[folded] = counts.get(folded, 0) + 1
+
+    def write(self, directory):
+        """ Write folded stacks for each stage (and all stages together) for flame graph tools
+            Args:
+                directory (str): directory to write <stage>.folded files to
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(os.path.sep.join([directory, "all.folded"]), 'w') as all_fobj:
+            for stage, counts in sorted(self.samples.items()):
+                with open(os.path.sep.join([directory, "{}.folded".format(stage)]), 'w') as fobj:
+                    for folded, count in sorted(counts.items()):
+                        fobj.write("{} {}\n".format(folded, count))
+                        all_fobj.write("{};{} {}\n".format(stage, folded, count))
+        LOGGER.info("Wrote profile for {} stages to {}".format(len(self.samples), directory))
+
+
+# Change detection functions
+################################################################################
+_previous_tree = {}     # Listing url -> fingerprint and records saved by the last run
+_current_tree = {}      # Listing url -> fingerprint and records scraped this run
+
+
+def load_tree_cache(path, refresh=False):
+    """ Load the tree saved by the last run
+        Args:
+            path (str): path to tree cache
+            refresh (bool): ignore the saved tree and scrape everything again
+    """
+    _previous_tree.clear()
+    _current_tree.clear()
+    if not refresh:
+        _previous_tree.update(load_json(path))
+
+
+def save_tree_cache(path):
+    """ Save the tree scraped this run (listings that weren't seen are dropped)
+        Args:
+            path (str): path to tree cache
+    """
+    save_json(path, _current_tree)
 
-    return brightcove_mapping
+
+def get_unchanged_branch(url, items, settings=None):
+    """ Fingerprint a listing by its ordered items and look up the last run's records for it
+        Args:
+            url (str): url of listing (e.g. snack subject or video collection)
+            items ([dict]): items listed, in order
+            settings (dict): options the records depend on (optional, e.g. whether playlists were split)
+        Returns
+            fingerprint (str): fingerprint of listing
+            records ([dict]): records saved for listing if it's unchanged and all of their files
+                (including local thumbnails and any split out `videos`) still exist, otherwise None
+    """
+    fingerprinted = items if settings is None else [items, settings]
+    fingerprint = hashlib.sha1(json.dumps(fingerprinted, sort_keys=True).encode('utf-8')).hexdigest()
+    previous = _previous_tree.get(url)
+    if previous and previous['fingerprint'] == fingerprint \
+            and all(os.path.isfile(path) for record in previous['records'] for path in get_record_files(record)):
+        _current_tree[url] = previous
+        return fingerprint, previous['records']
+    return fingerprint, None
+
+
+def get_record_files(record):
+    """ List the local files a saved record needs
+        Args:
+            record (dict): snack or video record with a `path` (and optionally `thumbnail` and `videos`)
+        Returns list of paths ([str])
+    """
+    items = [record] + record.get('videos', [])
+    return [item['path'] for item in items] \
+        + [item['thumbnail'] for item in items if is_local_thumbnail(item.get('thumbnail'))]
 
 
+def is_local_thumbnail(thumbnail):
+    """ Determine whether a thumbnail was saved locally (e.g. converted from a gif) rather than left as a url
+        Args:
+            thumbnail (str): thumbnail path or url (or None)
+        Returns True if thumbnail is a local file (bool)
+    """
+    return bool(thumbnail) and not thumbnail.startswith(('http://', 'https://'))
+
+
+def remember_branch(url, fingerprint, records):
+    """ Save the records scraped under a listing for the next run
+        Args:
+            url (str): url of listing
+            fingerprint (str): fingerprint of listing (see `get_unchanged_branch`)
+            records ([dict]): json-serializable records with a local file `path` each
+    """
+    _current_tree[url] = {"fingerprint": fingerprint, "records": records}
+
 
 # Video scraping functions
 ################################################################################
-def scrape_video_menu(url):
+@track_stage('scrape_video_menu')
+def scrape_video_menu(url, download_workers=4, transcode=None):
     """ Scrape videos from url
         Args:
             url (str): url to scrape from (e.g. https://www.exploratorium.edu/video/subjects)
+            download_workers (int): number of videos to download at a time
+            transcode (dict): ffmpeg settings to re-encode videos with (None to keep them as downloaded)
         Returns TopicNode containing all videos
     """
     LOGGER.info("SCRAPING VIDEOS...")
     video_topic = nodes.TopicNode(title="Videos", source_id="main-topic-videos")
     contents = BeautifulSoup(read(url), 'html5lib')
+    scheduler = DownloadScheduler("Video downloads", download_workers)
+    collections = []    # Functions that add each collection's videos once they're downloaded
 
     for subject in contents.find_all('div', {'class': 'subject'}):
         title = subject.find('div', {'class': 'name'}).text.strip().replace("’", "'")
@@ -224,17 +628,32 @@ def scrape_video_menu(url):
             thumbnail=get_thumbnail_url(subject.find('img')['src']),
         )
         video_topic.add_child(topic)
-        scrape_video_subject(subject.find('a')['href'], topic)
-
+        collections.extend(scrape_video_subject(subject.find('a')['href'], topic, scheduler, transcode))
+
+    contents.decompose()
+
+    # Download every collection's videos together, so the largest can start first
+    scheduler.run()
+    scheduler.close()
+    transcoded = {}
+    if transcode:
+        downloaded = [job.result() for job in scheduler.jobs if not job.future.exception()]
+        transcoded = dict(zip(downloaded, transcode_videos(downloaded, transcode)))
+    for add_collection in collections:
+        add_collection(transcoded)
     return video_topic
 
 
-def scrape_video_subject(url, topic):
+def scrape_video_subject(url, topic, scheduler, transcode=None):
     """ Scrape collections under video subject and add to the topic node
         Args:
             url (str): url to subject page (e.g. https://www.exploratorium.edu/search/video?f[0]=field_activity_subject%3A565)
             topic (TopicNode): topic to add collection nodes to
+            scheduler (DownloadScheduler): scheduler to queue video downloads on
+            transcode (dict): ffmpeg settings videos are re-encoded with (None if they aren't)
+        Returns list of functions that add each collection's videos once the scheduler has run
     """
+    collections = []
     contents = BeautifulSoup(read(url), 'html5lib')
     sidebar = contents.find("div", {"id": "filter_content"}).find("div", {"class": "content"})
     for collection in sidebar.find_all("li"):
@@ -242,61 +661,162 @@ def scrape_video_subject(url, topic):
         LOGGER.info("        {}".format(title))
         collection_topic = nodes.TopicNode(title=title, source_id="videos-collection-{}".format(title))
         topic.add_child(collection_topic)
-        scrape_video_collection(collection.find('a')['href'], collection_topic)
+        collections.append(scrape_video_collection(collection.find('a')['href'], collection_topic, scheduler, transcode))
+    contents.decompose()
+    return collections
 
 
-def scrape_video_collection(url, topic):
-    """ Scrape videos under video collection and add to the topic node
+def scrape_video_collection(url, topic, scheduler, transcode=None):
+    """ Scrape videos under video collection, queueing their downloads,
+        or reuse the last run's videos if the collection's listing hasn't changed
         Args:
             url (str): url to video page (e.g. https://www.exploratorium.edu/video/inflatable-jimmy-kuehnle)
             topic (TopicNode): topic to add video nodes to
+            scheduler (DownloadScheduler): scheduler to queue video downloads on
+            transcode (dict): ffmpeg settings videos are re-encoded with (None if they aren't)
+        Returns function that adds the collection's videos to the topic node once the scheduler has run,
+            given a dict mapping downloaded videos to their re-encoded versions
     """
-    try:
-        collection_contents = BeautifulSoup(read(url), 'html5lib')
+    results, complete = scrape_video_listing(url)
+    fingerprint, videos = get_unchanged_branch(url, results, settings=transcode and {"transcode": transcode} or None)
+    if videos is not None:
+        LOGGER.info("            (unchanged, reusing {} videos)".format(len(videos)))
+        charge_reused_videos(videos)
+        return lambda _transcoded: add_video_nodes(topic, videos)
+
+    pending = []
+    for result in results:
+        LOGGER.info("            {}".format(result['title']))
+        result_videos, result_complete = scrape_video_result(result, scheduler)
+        pending.extend(result_videos)
+        complete = complete and result_complete
+
+    def add_collection(transcoded):
+        videos = []
+        for video, job in pending:
+            try:
+                videos.append(dict(video, path=transcoded.get(job.result(), job.result())))
+            except (youtube_dl.utils.DownloadError, requests.exceptions.RequestException, IOError):
+                pass    # Error is logged by `download`
+
+        # Only remember collections without errors so failures are retried next run
+        if complete and len(videos) == len(pending):
+            remember_branch(url, fingerprint, videos)
+        add_video_nodes(topic, videos)
+
+    return add_collection
+
+
+def scrape_video_listing(url):
+    """ Scrape the results listed under a video collection (following pagination)
+        Args:
+            url (str): url to video collection
+        Returns
+            results ([dict]): url, title, description and thumbnail of each listed video page
+            complete (bool): whether every page of the listing could be read
+    """
+    results = []
+    while url:
+        try:
+            collection_contents = BeautifulSoup(read(url), 'html5lib')
+        except requests.exceptions.HTTPError:
+            LOGGER.error("Could not read collection at {}".format(url))
+            return results, False
+
         for result in collection_contents.find_all('div', {'class': 'search-result'}):
             header = result.find('div', {'class': 'views-field-field-html-title'})
-            LOGGER.info("            {}".format(header.text.strip()))
-
-            # Get video from given url
             description = result.find('div', {'class': 'search-description'})
-            video_contents = BeautifulSoup(read(header.find('a')['href']), 'html.parser')
-            for k, v in get_brightcove_mapping(video_contents).items():
-                video_node = nodes.VideoNode(
-                    source_id = k,
-                    title = header.text.strip().replace("’", "'"),
-                    description = description.text.strip() if description else "",
-                    license = LICENSE,
-                    copyright_holder = COPYRIGHT_HOLDER,
-                    author = v.get('author') or "",
-                    files = [files.WebVideoFile(v['url'], high_resolution=False)],
-                    thumbnail = get_thumbnail_url(result.find('img')['src']),
-                )
-
-                # If video doesn't already exist here, add to topic
-                if not next((c for c in topic.children if c.source_id == video_node.source_id), None):
-                    topic.add_child(video_node)
+            results.append({
+                "url": header.find('a')['href'],
+                "title": header.text.strip().replace("’", "'"),
+                "description": description.text.strip() if description else "",
+                "thumbnail": result.find('img')['src'],
+            })
 
         # Scrape next page (if any)
-        next_page_url = get_next_page_url(collection_contents)
-        if next_page_url:
-            scrape_video_collection(next_page_url, topic)
+        url = get_next_page_url(collection_contents)
+        collection_contents.decompose()
+
+    return results, True
+
 
+def scrape_video_result(result, scheduler):
+    """ Queue downloads for the videos on a listed video page
+        Args:
+            result (dict): listed video page (see `scrape_video_listing`)
+            scheduler (DownloadScheduler): scheduler to queue video downloads on
+        Returns
+            videos ([(dict, DownloadJob)]): id, title, description, author and thumbnail of each video,
+                with the job that downloads it (returning its path)
+            complete (bool): whether the page could be read
+    """
+    try:
+        video_contents = BeautifulSoup(read(result['url']), 'html.parser')
     except requests.exceptions.HTTPError:
-        LOGGER.error("Could not read collection at {}".format(url))
+        LOGGER.error("Could not read video at {}".format(result['url']))
+        return [], False
+    brightcove_videos = get_brightcove_videos(video_contents)
+    video_contents.decompose()
+
+    videos = []
+    for video in brightcove_videos:
+        job = scheduler.add(functools.partial(download_web_video, video['url'], video['id']),
+                            functools.partial(estimate_video_size, video['url'], video['id']))
+        videos.append(({
+            "id": video['id'],
+            "title": result['title'],
+            "description": result['description'],
+            "author": video['author'] or "",
+            "thumbnail": get_thumbnail_url(result['thumbnail']),
+        }, job))
+    return videos, True
+
+
+def add_video_nodes(topic, videos):
+    """ Add video nodes for downloaded videos
+        Args:
+            topic (TopicNode): topic to add video nodes to
+            videos ([dict]): videos to add (see `scrape_video_result`), with the path each was downloaded to
+    """
+    for video in videos:
+        # If video doesn't already exist here, add to topic
+        if next((c for c in topic.children if c.source_id == video['id']), None):
+            continue
+        use_cached_file(video['path'])
+        is_local_thumbnail(video['thumbnail']) and use_cached_file(video['thumbnail'])
+        topic.add_child(nodes.VideoNode(
+            source_id = video['id'],
+            title = video['title'],
+            description = video['description'],
+            license = LICENSE,
+            copyright_holder = COPYRIGHT_HOLDER,
+            author = video['author'],
+            files = [ChecksummedVideoFile(video['path'])],
+            thumbnail = video['thumbnail'],
+        ))
 
 
 
 
 # Activity scraping functions
 ################################################################################
-def scrape_snack_menu(url):
+_snacks = {}    # Snack slug -> scraped snack, as snacks can be listed under several subjects
+
+@track_stage('scrape_snack_menu')
+def scrape_snack_menu(url, fetch_workers=4, build_workers=0, split_playlists=False, transcode=None):
     """ Scrape snacks (activities) from  url
         Args:
             url (str): url to scrape from (e.g. https://www.exploratorium.edu/snacks/snacks-by-subject)
+            fetch_workers (int): number of threads to fetch snack pages with
+            build_workers (int): number of processes to zip snacks with (0 to zip in this process)
+            split_playlists (bool): add playlist videos as video nodes instead of embedding them in zips
+            transcode (dict): ffmpeg settings to re-encode videos with (None to keep them as downloaded)
         Returns TopicNode containing all snacks
     """
     LOGGER.info("SCRAPING ACTIVITIES...")
+    _snacks.clear()     # Scraped snacks are only reused within a run
     snack_topic = nodes.TopicNode(title="Activities", source_id="main-topic-activities")
+    listings = []       # (subject url, topic, activities) to add html nodes for once snacks are scraped
     contents = BeautifulSoup(read(url), 'html5lib')
 
     # Get #main-content-container .field-items
@@ -321,189 +841,532 @@ def scrape_snack_menu(url):
                     LOGGER.info("    > {}".format(sublink['title']))
                     subtopic = nodes.TopicNode(title=sublink['title'].replace("’", "'"), source_id=sublink['href'])
                     topic.add_child(subtopic)
-                    scrape_snack_subject(sublink['href'], subtopic)
+                    listings.append((sublink['href'], subtopic, scrape_snack_subject(sublink['href'])))
             else:
-                scrape_snack_subject(link['href'], topic)
+                listings.append((link['href'], topic, scrape_snack_subject(link['href'])))
+
+    contents.decompose()
+
+    # Reuse snacks from subjects whose listing hasn't changed since the last run
+    fingerprints = {}
+    settings = {key: value for key, value in [("split_playlists", split_playlists), ("transcode", transcode)] if value}
+    for subject_url, _topic, topic_activities in listings:
+        fingerprints[subject_url], snacks = get_unchanged_branch(subject_url, topic_activities,
+                                                                 settings=settings or None)
+        for snack in snacks or []:
+            _snacks[snack['key']] = snack
+            embedded = snack['embedded'] if 'embedded' in snack else get_embedded_videos(snack['path'])
+            charge_reused_videos(snack.get('videos', []), embedded)
+
+    # Scrape each remaining snack once, then add snacks everywhere they're listed
+    activities = {activity['key']: activity for _url, _topic, topic_activities in listings
+                  for activity in topic_activities if activity['key'] not in _snacks}
+    LOGGER.info("    Scraping {} new or changed snacks".format(len(activities)))
+    scrape_snacks(list(activities.values()), fetch_workers=fetch_workers, build_workers=build_workers,
+                  split_playlists=split_playlists, transcode=transcode)
+    for subject_url, topic, topic_activities in listings:
+        add_snack_nodes(topic, topic_activities)
+        snacks = [dict(_snacks[a['key']], key=a['key']) for a in topic_activities if _snacks.get(a['key'])]
+        if len(snacks) == len(topic_activities):
+            remember_branch(subject_url, fingerprints[subject_url], snacks)
 
     return snack_topic
 
 
-def scrape_snack_subject(slug, topic):
-    """ Scrape snack subject page
+def scrape_snack_subject(slug):
+    """ Scrape snack subject page (following pagination)
         Args:
             slug (str): url slug to scrape from (e.g. /subject/arts)
-            topic (TopicNode): topic to add html nodes to
+        Returns list of activities with slug, key, title, description and thumbnail keys ([dict])
     """
-    contents = BeautifulSoup(read(slug), 'html5lib')
+    activities = []
+    while slug:
+        contents = BeautifulSoup(read(slug), 'html5lib')
 
-    for activity in contents.find_all('div', {'class': 'activity'}):
-        LOGGER.info("        {}".format(activity.find('h5').text.strip()))
-        # Scrape snack pages into zips
-        write_to_path, tags = scrape_snack_page(activity.find('a')['href'])
-        if not write_to_path:
-            continue
+        for activity in contents.find_all('div', {'class': 'activity'}):
+            LOGGER.info("        {}".format(activity.find('h5').text.strip()))
+            activity_slug = activity.find('a')['href']
+            description = activity.find('div', {'class': 'pod-description'})
+            activities.append({
+                "slug": activity_slug,
+                "key": activity_slug.rstrip('/').split('/')[-1],
+                "title": activity.find('h5').text.strip().replace("’", "'"),
+                "description": description.text.strip() if description else "",
+                "thumbnail": activity.find('img')['src'],
+            })
+
+        # Scrape next page (if any)
+        slug = get_next_page_url(contents)
+        contents.decompose()
 
-        # Create html node
-        description = activity.find('div', {'class': 'pod-description'})
+    return activities
+
+
+def add_snack_nodes(topic, activities):
+    """ Add html nodes for scraped snacks
+        Args:
+            topic (TopicNode): topic to add html nodes to
+            activities ([dict]): activities listed under topic (see `scrape_snack_subject`)
+    """
+    for activity in activities:
+        snack = _snacks.get(activity['key'])
+        if not snack:
+            continue
+        use_cached_file(snack['path'])
+        is_local_thumbnail(snack['thumbnail']) and use_cached_file(snack['thumbnail'])
         topic.add_child(nodes.HTML5AppNode(
-            source_id = activity.find('a')['href'],
-            title = activity.find('h5').text.strip().replace("’", "'"),
-            description = description.text.strip() if description else "",
+            source_id = activity['slug'],
+            title = activity['title'],
+            description = activity['description'],
             license = LICENSE,
             copyright_holder = COPYRIGHT_HOLDER,
-            files = [files.HTMLZipFile(path=write_to_path)],
-            thumbnail = get_thumbnail_url(activity.find('img')['src']),
-            tags=tags,
+            files = [ChecksummedHTMLZipFile(path=snack['path'])],
+            thumbnail = snack['thumbnail'],
+            tags=snack['tags'],
         ))
 
-    # Scrape next page (if any)
-    next_page_url = get_next_page_url(contents)
-    if next_page_url:
-        scrape_snack_subject(next_page_url, topic)
+        # Add split out playlist videos next to the activity (shared with any other activity listing them)
+        add_video_nodes(topic, [dict(video,
+                                     title=video['title'] or activity['title'],
+                                     description="From the activity: {}".format(activity['title']),
+                                     thumbnail=video['thumbnail'] or snack['thumbnail'])
+                                for video in snack.get('videos', [])])
 
 
-def scrape_snack_page(slug, attempts=5):
+def scrape_snacks(activities, fetch_workers=4, build_workers=0, split_playlists=False, transcode=None):
+    """ Scrape snack pages into zips with a two-tier pipeline: I/O threads fetch the pages and
+        a process pool parses, rewrites and zips them. A bounded queue between the tiers stops
+        fetching from running too far ahead of zipping.
+        Args:
+            activities ([dict]): activities to scrape (see `scrape_snack_subject`)
+            fetch_workers (int): number of threads to fetch pages with
+            build_workers (int): number of processes to zip snacks with (0 to zip in this process)
+            split_playlists (bool): download playlist videos next to zips instead of embedding them
+            transcode (dict): ffmpeg settings to re-encode videos with (None to keep them as downloaded)
+    """
+    if not activities:
+        return
+    fetched = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    slots = threading.BoundedSemaphore(max(build_workers, 1) * 2)   # Snacks waiting on or being zipped
+    cancelled = threading.Event()   # Set if zipping fails, so fetches stop instead of waiting on the queue
+
+    def fetch(activity):
+        if cancelled.is_set():
+            return
+        try:
+            contents = read(activity['slug'])
+        except Exception:
+            contents = None     # The builder retries the fetch itself
+        while not cancelled.is_set():
+            try:
+                fetched.put((activity, contents), timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    if build_workers:
+        # Workers are forked so they inherit the open archive and output directory. The pool forks
+        # all of them on its first task, so run one now: forking once the fetch threads have
+        # started could copy a lock one of them holds into the children and deadlock them
+        fork = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        builder = ProcessPoolExecutor(max_workers=build_workers, mp_context=fork)
+        builder.submit(int).result()
+    else:
+        builder = ThreadPoolExecutor(max_workers=1)
+    with ThreadPoolExecutor(max_workers=fetch_workers) as fetcher, builder:
+        for activity in activities:
+            fetcher.submit(fetch, activity)
+
+        futures = []
+        try:
+            for _index in range(len(activities)):
+                activity, contents = fetched.get()
+                slots.acquire()
+                future = builder.submit(scrape_snack_page, activity['slug'], contents=contents,
+                                        split_playlists=split_playlists, transcode=transcode)
+                future.add_done_callback(lambda _future: slots.release())
+                futures.append((activity, future))
+        except BaseException:
+            # e.g. BrokenProcessPool after a worker was killed: release the fetch threads so the pools can shut down
+            cancelled.set()
+            raise
+
+        for activity, future in futures:
+            write_to_path, tags, videos = future.result()
+            _snacks[activity['key']] = write_to_path and {
+                "path": write_to_path,
+                "tags": tags,
+                "thumbnail": get_thumbnail_url(activity['thumbnail']),
+                "videos": videos,
+                "embedded": get_embedded_videos(write_to_path),
+            }
+            # Zips kept from an earlier run didn't download (or charge) their videos this run
+            write_to_path and charge_reused_videos([], _snacks[activity['key']]['embedded'])
+    SNACK_DOWNLOADS.close()
+
+
+@track_stage('scrape_snack_page')
+def scrape_snack_page(slug, attempts=5, contents=None, split_playlists=False, transcode=None):
     """ Writes activity to a zipfile
         Args:
             slug (str): url slug (e.g. /snacks/drawing-board)
             attemps (int): number of times to attempt a download
+            contents (bytes): already fetched page contents to use for the first attempt (optional)
+            split_playlists (bool): download playlist videos separately instead of embedding them in the zip
+            transcode (dict): ffmpeg settings to re-encode videos with (None to keep them as downloaded)
         Returns
-            write_to_path (str): path to generated zip
+            write_to_path (str): path to generated zip (None if the activity couldn't be scraped
+                and wasn't zipped by an earlier run)
             tags ([str]): list of tags scraped from activity page
+            videos ([dict]): playlist videos split out of the zip (see `download_playlist_videos`)
     """
-    tags = []
-    write_to_path = os.path.sep.join([SNACK_DIRECTORY, "{}.zip".format(slug.split('/')[-1])])
-
-    try:
-        contents = BeautifulSoup(read(slug), 'html5lib')
-        main_contents = contents.find('div', {'class': 'activity'})
+    # Zips without their playlist videos (or with re-encoded videos) are kept apart so switching
+    # modes never reuses the wrong zip
+    filename = slug.split('/')[-1]
+    filename += "-split" if split_playlists else ""
+    filename += "-{}".format(get_transcode_key(transcode)) if transcode else ""
+    write_to_path = os.path.sep.join([SNACK_DIRECTORY, "{}.zip".format(filename)])
+
+    for attempt in range(attempts + 1):
+        try:
+            return write_snack_zip(slug, write_to_path, contents=contents, split_playlists=split_playlists,
+                                   transcode=transcode)
+        except Exception as e:
+            contents = None     # Fetch the page again on the next attempt
+            error = e
+            if os.path.isfile("{}.part".format(write_to_path)):
+                os.remove("{}.part".format(write_to_path))
 
-        # Gather keywords from page
-        tags.extend(scrape_keywords(main_contents, 'field-name-field-activity-subject'))
-        tags.extend(scrape_keywords(main_contents, 'field-name-field-activity-tags'))
+    LOGGER.error("Could not scrape {} ({})".format(slug, str(error)))
+    # Keep using a zip finished by an earlier run
+    return (write_to_path if os.path.isfile(write_to_path) else None), [], []
 
-        # Don't rezip activities that have already been zipped
-        if os.path.isfile(write_to_path):
-            return write_to_path, tags
 
-        with html_writer.HTMLWriter(write_to_path) as zipper:
-            write_contents = BeautifulSoup("", "html5lib")
+def write_snack_zip(slug, write_to_path, contents=None, split_playlists=False, transcode=None):
+    """ Scrape activity page and write it to a zipfile (if it hasn't been zipped yet)
+        Args:
+            slug (str): url slug (e.g. /snacks/drawing-board)
+            write_to_path (str): where to write zip to
+            contents (bytes): already fetched page contents (optional)
+            split_playlists (bool): download playlist videos separately instead of embedding them in the zip
+            transcode (dict): ffmpeg settings to re-encode videos with (None to keep them as downloaded)
+        Returns
+            write_to_path (str): path to generated zip
+            tags ([str]): list of tags scraped from activity page
+            videos ([dict]): playlist videos split out of the zip (see `download_playlist_videos`)
+    """
+    # Only keep the activity section and stylesheet attributes so the full page can be freed
+    contents = BeautifulSoup(contents or read(slug), 'html5lib')
+    main_contents = contents.find('div', {'class': 'activity'}).extract()
+    stylesheets = [dict(stylesheet.attrs) for stylesheet in contents.find_all('link', {'rel': 'stylesheet'})]
+    contents.decompose()
 
-            # Scrape stylesheets
-            for stylesheet in contents.find_all('link', {'rel': 'stylesheet'}):
-                # Don't scrape external style sheets (e.g. fontawesome, google fonts)
-                if "exploratorium.edu" not in stylesheet['href']:
-                    continue
-                style_contents = scrape_style(stylesheet['href'], zipper)
-                filename = stylesheet['href'].split('/')[-1]
-                stylesheet['href'] = zipper.write_contents(filename, style_contents, directory="css")
-                write_contents.head.append(stylesheet)
-
-            # Remove scripts and any unneeded sections
-            cluster = main_contents.find('div', {'id': 'curated-cluster'})
-            cluster and cluster.decompose()
-            service_links = main_contents.find('div', {'class': 'activity-service-links'})
-            service_links and service_links.decompose()
-            for script in main_contents.find_all("script"):
-                script.decompose()
-
-            # Get rid of hardcoded height/width on slideshow element
-            slideshow = main_contents.find('div', {'class': 'field-slideshow'})
-            if slideshow:
-                del slideshow['style']
-
-            # Add images
-            for img in main_contents.find_all('img'):
-                img['src'] = zipper.write_url(format_url(img['src']), img['src'].split('/')[-1], directory="images")
-
-            # Add videos embedded from youtube
-            for video in main_contents.find_all('div', {'class': 'yt-player'}):
-                yt_video_path = download_web_video(video['data-ytid'], "{}.mp4".format(video['data-ytid']))
-                video_tag = generate_video_tag(yt_video_path, zipper)
-                video_tag['style'] = video.find('div', {'class': 'placeholder'}).get('style')
-                video.replaceWith(video_tag)
-
-            # Add videos embedded from brightcove and remove playlist element (if any)
-            for k, v in get_brightcove_mapping(main_contents, get_playlist=True).items():
-                video_path = download_web_video(v['url'], "{}.mp4".format(k))
-                if v.get('original_el'):
-                    v['original_el'].replaceWith(generate_video_tag(video_path, zipper))
-                elif v.get('append_to'):
-                    if v.get('title'):
-                        p_tag = contents.new_tag("p")
-                        p_tag.string = v['title']
-                        p_tag['style'] = "margin-top: 40px; margin-bottom: 10px"
-                        v['append_to'].parent.append(p_tag)
-                    v['append_to'].parent.append(generate_video_tag(video_path, zipper))
-            playlist = main_contents.find('div', {'id': 'media-collection-banner-playlist'})
-            if playlist:
-                playlist.decompose()
-
-            # Handle links (need to start with parent as beautifulsoup returns parent as None on links)
-            for paragraph in main_contents.find_all('p') + main_contents.find_all('li'):
-                for link in paragraph.find_all('a'):
-                    # Skip any previously parsed links
-                    if zipper.contains(link['href']):
-                        continue
-
-                    # Just bold activities and remove link
-                    elif "exploratorium.edu/snacks/" in link['href']:
-                        bold_tag = contents.new_tag("b")
-                        bold_tag.string = link.text
-                        link.replaceWith(bold_tag)
-
-                    # If it's an image, replace the tag with just the image
-                    elif link.find('img'):
-                        link.replaceWith(link.find('img'))
-
-                    # Get downloadable files and attach them to new pages
-                    elif "/sites/default/files/" in link['href']:
-                        link['href'] = generate_download_page(link['href'], zipper)
-
-                    # Get any referenced videos
-                    elif "exploratorium.edu" in link['href']:
-                        linked_page = BeautifulSoup(read(link['href']), 'html5lib')
-                        link.replaceWith(link.text.replace(link['href'], ''))
-                        for k, v in get_brightcove_mapping(linked_page).items():
-                            video_path = download_web_video(v['url'], "{}.mp4".format(k))
-                            paragraph.append(generate_video_tag(video_path, zipper))
-
-                    # Scrape any images
-                    elif next((e for e in IMAGE_EXTENSIONS if link['href'].lower().endswith(e)), None):
-                        img_tag = contents.new_tag('img')
-                        img_tag['src'] = zipper.write_url(link['href'], link['href'].split('/')[-1], directory="images")
-                        img_tag['style'] = "max-width: 100%;"
-                        paragraph.append(img_tag)
-                        link.replaceWith(link.text)
-
-                    # Remove hyperlink from external links
-                    else:
-                        if link['href'] not in link.text and link.text not in link['href']:
-                            link.string += " ({}) ".format(link['href'])
-                        link.replaceWith(link.text)
-
-            # Write contents and custom tags
-            write_contents.body.append(main_contents)
-            write_contents.head.append(generate_custom_style_tag()) # Add custom style tag
-            write_contents.body.append(generate_custom_script_tag()) # Add custom script to handle slideshow
-
-            # Write main index.html file
-            zipper.write_index_contents(write_contents.prettify().encode('utf-8-sig'))
-
-    except Exception as e:
-        # Reattempt if there are attempts left
-        if attempts > 0:
-            return scrape_snack_page(slug, attempts=attempts-1)
-        else:
-            LOGGER.error("Could not scrape {} ({})".format(slug, str(e)))
-    return write_to_path, tags
+    # Gather keywords from page
+    tags = []
+    tags.extend(scrape_keywords(main_contents, 'field-name-field-activity-subject'))
+    tags.extend(scrape_keywords(main_contents, 'field-name-field-activity-tags'))
+
+    # Playlist videos are needed whether or not the zip already exists
+    playlist = main_contents.find('div', {'id': 'media-collection-banner-playlist'})
+    videos = []
+    if split_playlists and playlist:
+        account = get_brightcove_account(main_contents)
+        videos = download_playlist_videos(get_playlist_videos(playlist, account), transcode=transcode)
+
+    # Don't rezip activities that have already been zipped
+    if os.path.isfile(write_to_path):
+        main_contents.decompose()
+        return write_to_path, tags, videos
+
+    # Write to a partial file first, so an interrupted write is never mistaken for a finished zip
+    part_path = "{}.part".format(write_to_path)
+    with html_writer.HTMLWriter(part_path) as zipper:
+        write_contents = BeautifulSoup("", "html5lib")
+
+        # Scrape stylesheets
+        for attrs in stylesheets:
+            # Don't scrape external style sheets (e.g. fontawesome, google fonts)
+            if "exploratorium.edu" not in attrs['href']:
+                continue
+            style_contents = scrape_style(attrs['href'], zipper)
+            filename = attrs['href'].split('/')[-1]
+            attrs['href'] = zipper.write_contents(filename, style_contents, directory="css")
+            stylesheet = write_contents.new_tag('link')
+            stylesheet.attrs.update(attrs)
+            write_contents.head.append(stylesheet)
+
+        # Rewrite activity section, pulling its images, videos and downloads into the zip
+        SnackRewriter(zipper, write_contents, split_playlists=split_playlists, transcode=transcode).rewrite(main_contents)
+
+        # Write contents and custom tags
+        write_contents.body.append(main_contents)
+        write_contents.head.append(generate_custom_style_tag()) # Add custom style tag
+        write_contents.body.append(generate_custom_script_tag()) # Add custom script to handle slideshow
+
+        # Write main index.html file
+        zipper.write_index_contents(write_contents.prettify().encode('utf-8-sig'))
+        write_contents.decompose()
+
+    # Hash the zip while it's still in the page cache (the zip writer seeks back, so it can't be hashed as it streams)
+    md5 = UPLOAD_CHECKSUMS and hash_file(part_path)
+    os.replace(part_path, write_to_path)
+    md5 and record_checksum(write_to_path, md5)
+    return write_to_path, tags, videos
+
+
+def get_embedded_videos(zip_path):
+    """ List the videos embedded in a snack zip
+        Args:
+            zip_path (str): path to snack zip
+        Returns dict mapping video filenames to their size in the zip
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        return {os.path.basename(info.filename): info.file_size for info in zf.infolist()
+                if info.filename.startswith("videos/")}
 
 
-def generate_download_page(url, zipper):
+class SnackRewriter(object):
+    """
+    Rewrites a snack's activity section for its zip in a single pass over the tree.
+    Each element is classified once and dispatched to a handler. Handlers edit the
+    tree in place and queue the assets they need, which `flush` then fetches in batches.
+    """
+    REMOVED_IDS = ['curated-cluster']
+    REMOVED_CLASSES = ['activity-service-links']
+    BLOCK_TAGS = ['p', 'li']    # Links are only rewritten inside these tags
+
+    def __init__(self, zipper, soup, split_playlists=False, transcode=None):
+        self.zipper = zipper
+        self.soup = soup                # Soup to create new tags with
+        self.split_playlists = split_playlists  # Playlist videos are added next to the activity instead
+        self.transcode = transcode      # ffmpeg settings to re-encode videos with (None to zip them as downloaded)
+        self.contents = None            # Element being rewritten
+        self.account = None             # Brightcove account (not stored on playlist items)
+        self.assets = {}                # Path in zip -> url to fetch it from
+        self.videos = {}                # Video id -> url to download it from
+        self.linked_pages = []          # (url, placeholder tag) for pages to pull videos from
+
+    def rewrite(self, contents):
+        """ Rewrite contents and write everything it references to the zip
+            Args:
+                contents (BeautifulSoup): activity section to rewrite
+        """
+        self.contents = contents
+        self.visit(contents, None)
+        self.flush()
+
+    def visit(self, element, block):
+        """ Visit element's descendants, handling children after their own descendants
+            Args:
+                element (BeautifulSoup): element to visit
+                block (BeautifulSoup): closest enclosing <p> or <li> (None if there isn't one)
+        """
+        for child in list(element.children):
+            if not isinstance(child, Tag):
+                continue
+            if self.is_removed(child):
+                child.decompose()
+                continue
+            self.visit(child, child if child.name in self.BLOCK_TAGS else block)
+            self.handle(child, block)
+
+    def is_removed(self, element):
+        """ Determine whether element should be left out of the zip (scripts and unneeded sections) """
+        classes = element.get('class') or []
+        return element.name == 'script' or element.get('id') in self.REMOVED_IDS \
+            or any(c in self.REMOVED_CLASSES for c in classes)
+
+    def handle(self, element, block):
+        """ Dispatch element to its handler (if any) """
+        classes = element.get('class') or []
+        if element.name == 'img':
+            element['src'] = self.queue_asset(element['src'], element['src'].split('/')[-1], directory="images")
+        elif element.name == 'a' and block and element.get('href'):
+            self.handle_link(element, block)
+        elif element.name == 'video' and 'bc5player' in classes:
+            self.handle_brightcove_video(element)
+        elif element.name != 'div':
+            return
+        elif 'yt-player' in classes:
+            self.handle_youtube_video(element)
+        elif 'field-slideshow' in classes:
+            del element['style']    # Get rid of hardcoded height/width on slideshow element
+        elif element.get('id') == 'media-collection-banner-playlist':
+            self.handle_playlist(element)
+
+    def handle_youtube_video(self, element):
+        """ Replace youtube player with a <video> tag """
+        video_tag = self.queue_video(element['data-ytid'], element['data-ytid'])
+        video_tag['style'] = element.find('div', {'class': 'placeholder'}).get('style')
+        element.replaceWith(video_tag)
+
+    def handle_brightcove_video(self, element):
+        """ Replace brightcove player with a <video> tag """
+        self.account = element['data-account']
+        url = BRIGHTCOVE_URL.format(account=element['data-account'],
+                                    player=element['data-player'],
+                                    videoid=element['data-video-id'])
+        element.replaceWith(self.queue_video(url, element['data-video-id']))
+
+    def handle_playlist(self, element):
+        """ Add a <video> tag after the playlist for each of its videos (or a note pointing to the
+            split out videos) and remove the playlist
+        """
+        account = self.account or get_brightcove_account(self.contents)
+        if self.split_playlists:
+            p_tag = self.soup.new_tag("p")
+            p_tag.string = "The videos for this activity can be found next to it in this topic."
+            p_tag['style'] = "margin-top: 40px; font-style: italic;"
+            element.parent.append(p_tag)
+            element.decompose()
+            return
+
+        for video in get_playlist_videos(element, account):
+            if video['title']:
+                p_tag = self.soup.new_tag("p")
+                p_tag.string = video['title']
+                p_tag['style'] = "margin-top: 40px; margin-bottom: 10px"
+                element.parent.append(p_tag)
+            element.parent.append(self.queue_video(video['url'], video['id']))
+        element.decompose()
+
+    def handle_link(self, link, block):
+        """ Rewrite link depending on where it points to
+            Args:
+                link (BeautifulSoup): <a> tag to rewrite
+                block (BeautifulSoup): enclosing <p> or <li> to add any extra content to
+        """
+        href = link['href']
+
+        # Just bold activities and remove link
+        if "exploratorium.edu/snacks/" in href:
+            bold_tag = self.soup.new_tag("b")
+            bold_tag.string = link.text
+            link.replaceWith(bold_tag)
+
+        # If it's an image, replace the tag with just the image
+        elif link.find('img'):
+            link.replaceWith(link.find('img'))
+
+        # Get downloadable files and attach them to new pages
+        elif "/sites/default/files/" in href:
+            link['href'] = generate_download_page(href, self)
+
+        # Get any referenced videos (added where the link was once the page is read)
+        elif "exploratorium.edu" in href:
+            placeholder = self.soup.new_tag("span")
+            block.append(placeholder)
+            self.linked_pages.append((href, placeholder))
+            link.replaceWith(link.text.replace(href, ''))
+
+        # Scrape any images
+        elif next((e for e in IMAGE_EXTENSIONS if href.lower().endswith(e)), None):
+            img_tag = self.soup.new_tag('img')
+            img_tag['src'] = self.queue_asset(href, href.split('/')[-1], directory="images")
+            img_tag['style'] = "max-width: 100%;"
+            block.append(img_tag)
+            link.replaceWith(link.text)
+
+        # Remove hyperlink from external links
+        else:
+            if href not in link.text and link.text not in href:
+                link.string += " ({}) ".format(href)
+            link.replaceWith(link.text)
+
+    def queue_asset(self, url, filename, directory=None):
+        """ Queue a file to be fetched into the zip
+            Args:
+                url (str): url to file
+                filename (str): name of file in zip
+                directory (str): directory in zip to write file to (optional)
+            Returns path to file in zip (str)
+        """
+        path = "{}/{}".format(directory, filename) if directory else filename
+        self.assets.setdefault(path, format_url(url))
+        return path
+
+    def queue_video(self, url, video_id):
+        """ Queue a web video to be downloaded into the zip
+            Args:
+                url (str): url to video
+                video_id (str): brightcove or youtube id of video
+            Returns <video> tag
+        """
+        self.videos.setdefault(video_id, url)
+        return generate_video_tag("videos/{}.mp4".format(video_id))
+
+    def flush(self):
+        """ Fetch queued pages, then assets and videos largest first, and write them to the zip """
+        # Linked pages can add more videos, so read them first
+        linked_contents = SNACK_DOWNLOADS.get_executor().map(read, [url for url, _placeholder in self.linked_pages])
+        for (_url, placeholder), contents in zip(self.linked_pages, linked_contents):
+            linked_page = BeautifulSoup(contents, 'html5lib')
+            for video in get_brightcove_videos(linked_page):
+                placeholder.insert_before(self.queue_video(video['url'], video['id']))
+            linked_page.decompose()
+            placeholder.extract()
+
+        asset_jobs = [(path, DownloadJob(functools.partial(read, url), functools.partial(estimate_asset_size, url)))
+                      for path, url in self.assets.items()]
+        video_jobs = [DownloadJob(functools.partial(download_web_video, url, video_id),
+                                  functools.partial(estimate_video_size, url, video_id))
+                      for video_id, url in self.videos.items()]
+        SNACK_DOWNLOADS.run([job for _path, job in asset_jobs] + video_jobs)
+        for path, job in asset_jobs:
+            self.zipper.write_contents(path, job.result())
+        video_paths = [job.result() for job in video_jobs]
+        encoded_paths = transcode_videos(video_paths, self.transcode) if self.transcode else video_paths
+        for video_path, encoded_path in zip(video_paths, encoded_paths):
+            self.zipper.write_file(encoded_path, filename=os.path.basename(video_path), directory="videos")
+
+
+def get_playlist_videos(playlist, account):
+    """ Scrape a brightcove playlist for its videos
+        Args:
+            playlist (BeautifulSoup): #media-collection-banner-playlist element
+            account (str): brightcove account playlist belongs to
+        Returns list of video records with id, title, url and thumbnail keys ([dict])
+    """
+    videos = []
+    for video in playlist.find_all('div', {'class': 'playlist-item'}):
+        thumbnail = video.find('img')
+        videos.append({
+            "id": video['data-id'],
+            "title": video.get('data-title') or "",
+            "url": BRIGHTCOVE_URL.format(account=account, player=video['data-pid'], videoid=video['data-id']),
+            "thumbnail": thumbnail and thumbnail.get('src'),
+        })
+    return videos
+
+
+def download_playlist_videos(videos, transcode=None):
+    """ Download playlist videos to the video directory to add as their own nodes
+        Args:
+            videos ([dict]): videos to download (see `get_playlist_videos`)
+            transcode (dict): ffmpeg settings to re-encode videos with (None to keep them as downloaded)
+        Returns list of downloaded videos with id, title, author, path and thumbnail keys ([dict])
+    """
+    jobs = [DownloadJob(functools.partial(download_web_video, video['url'], video['id']),
+                        functools.partial(estimate_video_size, video['url'], video['id']))
+            for video in videos]
+    SNACK_DOWNLOADS.run(jobs)
+    paths = [job.result() for job in jobs]
+    if transcode:
+        paths = transcode_videos(paths, transcode)
+    return [{
+        "id": video['id'],
+        "title": video['title'],
+        "author": "",
+        "path": path,
+        "thumbnail": video['thumbnail'] and get_thumbnail_url(video['thumbnail']),
+    } for video, path in zip(videos, paths)]
+
+
+def generate_download_page(url, rewriter):
     """ Create a page for files that are meant to be downloaded (e.g. worksheets)
         Args:
             url (str): url to file that is meant to be downloaded
-            zipper (html_writer): where to write download page to
+            rewriter (SnackRewriter): rewriter to write download page and queue file with
         Returns path to page in zipfile (str)
     """
     # Get template soup
@@ -523,22 +1386,21 @@ def generate_download_page(url, zipper):
         return ""
 
     # Add tag to new page and write page to zip
-    render_tag['src'] = zipper.write_url(format_url(download_url), filename)
+    render_tag['src'] = rewriter.queue_asset(download_url, filename)
     newpage.body.append(render_tag)
-    return zipper.write_contents(filename.split('.')[0] + ".html", newpage.prettify())
+    return rewriter.zipper.write_contents(filename.split('.')[0] + ".html", newpage.prettify())
 
 
-def generate_video_tag(filepath, zipper):
-    """ Downloads video into zip and creates a corresponding <video> tag
+def generate_video_tag(src):
+    """ Creates a <video> tag
         Args:
-            filepath (str): path to video to zip
-            zipper (html_writer): where to write video to
+            src (str): path to video in zip
         Returns <video> tag
     """
     soup = BeautifulSoup("", "html.parser")
     video_tag = soup.new_tag("video")
     source_tag = soup.new_tag("source")
-    source_tag['src'] = zipper.write_file(filepath, directory="videos")
+    source_tag['src'] = src
     source_tag['type'] = "video/mp4"
     video_tag['controls'] = 'true'
     video_tag['style'] = "width: 100%;"
@@ -581,20 +1443,65 @@ def generate_custom_script_tag():
     return script_tag
 
 
-def download_web_video(url, filename):
-    """ Downloads a web video to the video directory
+def download_web_video(url, video_id):
+    """ Downloads a web video to the video directory (shared by snacks and the videos tree)
         Args:
             url (str): url to video to download
-            filename (str): name to save video under
+            video_id (str): brightcove or youtube id to cache video under
         Returns local path to video (str)
     """
-    # Generate write to path and download if it doesn't exist yet
-    write_to_path = os.path.sep.join([VIDEO_DIRECTORY, filename])
-    if not os.path.isfile(write_to_path):
-        download(url, write_to_path)
+    # Generate write to path and download if it doesn't exist yet (or was left broken by an older run)
+    write_to_path = get_video_path(video_id)
+    archive_key = "video:{}".format(url)
+    with get_video_lock(video_id), file_lock(write_to_path):
+        if os.path.isfile(write_to_path) and not verify_video(write_to_path):
+            LOGGER.warning("Removing corrupted video {}".format(write_to_path))
+            os.remove(write_to_path)
+        if not os.path.isfile(write_to_path):
+            if ARCHIVE and not ARCHIVE.recording:
+                ARCHIVE.get_file(archive_key, write_to_path)
+            else:
+                download(url, write_to_path)
+        else:
+            # Videos kept from a run with a bigger (or no) budget aren't downloaded again
+            max_bytes = load_json(VIDEO_BUDGET_PATH).get('video_budget')
+            if max_bytes is not None and os.path.getsize(write_to_path) > max_bytes:
+                LOGGER.warning("Cached video {} ({:.1f} MB) is over the {:.1f} MB video budget (delete it to download "
+                               "a smaller format)".format(write_to_path, os.path.getsize(write_to_path) / 1024 / 1024,
+                                                          max_bytes / 1024 / 1024))
+
+        # Videos that weren't hashed while downloading (e.g. merged by youtube_dl) are hashed once here
+        if UPLOAD_CHECKSUMS and not get_checksum(write_to_path):
+            record_checksum(write_to_path, hash_file(write_to_path))
+
+        # Record cached videos too, so the archive can replay the run on a fresh machine
+        if ARCHIVE and ARCHIVE.recording and archive_key not in ARCHIVE:
+            ARCHIVE.put_file(archive_key, write_to_path)
+    charge_video_budget(write_to_path, os.path.getsize(write_to_path))
+    use_cached_file(write_to_path)
     return write_to_path
 
 
+def get_video_path(video_id):
+    """ Get where a web video is cached in the video directory
+        Args:
+            video_id (str): brightcove or youtube id of video
+        Returns path to video (str)
+    """
+    return os.path.sep.join([VIDEO_DIRECTORY, "{}.mp4".format(video_id)])
+
+
+def get_video_lock(video_id):
+    """ Get lock so each video is only downloaded once when scraping in parallel
+        Args:
+            video_id (str): id video is cached under
+        Returns threading.Lock
+    """
+    with _video_info_lock:
+        return _video_locks.setdefault(video_id, threading.Lock())
+
+
+@track_stage('download')
 def download(url, write_to_path, attempts=DOWNLOAD_ATTEMPTS):
     """ Download the web video
         Args:
@@ -603,10 +1510,33 @@ def download(url, write_to_path, attempts=DOWNLOAD_ATTEMPTS):
             attempts (int): how many times to reattempt a download
     """
     try:
-        video_format = "bestvideo[height<=480][ext=mp4]+bestaudio[ext=m4a]/best[height<=480][ext=mp4]"
-        with youtube_dl.YoutubeDL({"format": video_format, "outtmpl": write_to_path}) as ydl:
-            ydl.download([url])
-    except youtube_dl.utils.DownloadError as e:
+        max_bytes = get_video_budget(write_to_path)
+        while True:
+            info, extracted = get_video_info(url, max_bytes=max_bytes)
+            # Reserve until the real size is known, picking again if other downloads took the budget meanwhile
+            budget_left = reserve_video_budget(write_to_path, info['filesize'] or 0, max_bytes)
+            if budget_left is None:
+                break
+            max_bytes = budget_left
+        if max_bytes is not None and (info['filesize'] or 0) > max_bytes:
+            LOGGER.warning("Smallest format of {} ({:.1f} MB) is over its {:.1f} MB budget".format(
+                url, info['filesize'] / 1024 / 1024, max_bytes / 1024 / 1024))
+
+        # Go straight to the media if a single direct url was selected
+        if info.get('url'):
+            download_media_url(info['url'], write_to_path, headers=info.get('http_headers'))
+        else:
+            ydl = get_youtube_dl()
+            ydl.params['outtmpl'] = write_to_path
+            ydl.process_info(extracted or extract_video_info(url, max_bytes=max_bytes)[1])
+            if not verify_video(write_to_path):
+                os.remove(write_to_path)
+                raise IOError("Video {} is corrupted".format(write_to_path))
+
+    except (youtube_dl.utils.DownloadError, requests.exceptions.RequestException, IOError) as e:
+        # Media urls may have expired, so extract the video again on the next attempt
+        clear_video_info(url)
+
         # If there are more attempts, try again. Otherwise, return error
         if attempts > 0:
             download(url, write_to_path, attempts=attempts-1)
@@ -615,6 +1545,94 @@ def download(url, write_to_path, attempts=DOWNLOAD_ATTEMPTS):
             raise e
 
 
+def download_media_url(media_url, write_to_path, headers=None):
+    """ Stream a direct media url to a file, resuming from any partial download
+        Args:
+            media_url (str): direct url to media file
+            write_to_path (str): where to write media to
+            headers (dict): http headers to send with the request (optional)
+    """
+    part_path = "{}.part".format(write_to_path)
+    headers = dict(headers or {})
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    if offset:
+        headers['Range'] = "bytes={}-".format(offset)
+
+    response = get_media_session().get(media_url, headers=headers, stream=True, timeout=60)
+    expected_size = None
+    file_hash = UPLOAD_CHECKSUMS and hashlib.md5()  # Hash as we write so uploading doesn't have to reread the video
+    if response.status_code == 416:     # Partial file already has every byte
+        response.close()
+        file_hash and hash_file(part_path, file_hash)
+    else:
+        response.raise_for_status()
+        if response.status_code != 206:  # Server ignored the range, so start over
+            offset = 0
+        if offset and file_hash:
+            hash_file(part_path, file_hash)
+        expected_size = get_expected_size(response, offset)
+        with open(part_path, 'ab' if offset else 'wb') as fobj:
+            for chunk in response.iter_content(chunk_size=MEDIA_CHUNK_SIZE):
+                fobj.write(chunk)
+                file_hash and file_hash.update(chunk)
+
+    # Keep short files around to resume from, but discard anything that can't be resumed
+    size = os.path.getsize(part_path)
+    if expected_size and size < expected_size:
+        raise IOError("Download of {} stopped at {} of {} bytes".format(media_url, size, expected_size))
+    if not verify_video(part_path, expected_size=expected_size):
+        os.remove(part_path)
+        raise IOError("Downloaded video {} is corrupted".format(media_url))
+    os.replace(part_path, write_to_path)
+    file_hash and record_checksum(write_to_path, file_hash.hexdigest())
+
+
+def get_expected_size(response, offset):
+    """ Get total size of a media file from response headers
+        Args:
+            response (requests.Response): response to a (possibly ranged) request
+            offset (int): number of bytes already downloaded
+        Returns total size in bytes (int) or None if unknown
+    """
+    content_range = response.headers.get('Content-Range', '')
+    if '/' in content_range and content_range.split('/')[-1].isdigit():
+        return int(content_range.split('/')[-1])
+    if response.headers.get('Content-Length', '').isdigit():
+        return offset + int(response.headers['Content-Length'])
+
+
+def verify_video(filepath, expected_size=None):
+    """ Check that a video is complete: size matches and the mp4 box structure is intact
+        Args:
+            filepath (str): path to video
+            expected_size (int): number of bytes video should have (optional)
+        Returns True if video looks complete (bool)
+    """
+    size = os.path.getsize(filepath)
+    if not size or (expected_size and size != expected_size):
+        return False
+
+    # Walk top-level boxes: a truncated file has a box running past the end of the file
+    boxes = set()
+    offset = 0
+    with open(filepath, 'rb') as fobj:
+        while offset < size:
+            fobj.seek(offset)
+            header = fobj.read(16)
+            if len(header) < 8:
+                return False
+            box_size = int.from_bytes(header[:4], 'big')
+            boxes.add(header[4:8])
+            if box_size == 1:               # 64-bit box size follows the type
+                box_size = int.from_bytes(header[8:16], 'big')
+            elif box_size == 0:             # Box runs to the end of the file
+                box_size = size - offset
+            if box_size < 8:
+                return False
+            offset += box_size
+    return offset == size and {b'ftyp', b'moov', b'mdat'} <= boxes
+
+
 def scrape_keywords(contents, el):
     """ Scrape page contents for keywords
         Args:
@@ -635,6 +1653,7 @@ def scrape_keywords(contents, el):
     return tags
 
 
+@track_stage('scrape_style')
 def scrape_style(url, zipper):
     """ Scrape any instances of url(...)
         Args:
@@ -642,27 +1661,1143 @@ def scrape_style(url, zipper):
             zipper (html_writer): zip to write to
         Returns str of css style rules
     """
-    sheet = cssutils.parseUrl(url)
+    rules = read(url).decode('utf-8-sig', errors='replace')
+    try:
+        references = find_css_urls(rules)
+    except ValueError as e:
+        LOGGER.warning("Falling back to cssutils for {} ({})".format(url, str(e)))
+        return rewrite_css_urls_with_cssutils(rules, url, zipper)
+
+    # Download any urls in css to the shared asset directory at once, then rewrite them in one pass
+    asset_urls = {ref: urljoin(url, ref) for _start, _end, ref in references if is_css_asset(ref)}
+    with ThreadPoolExecutor(max_workers=ASSET_WORKERS) as executor:
+        filepaths = dict(zip(asset_urls.values(), executor.map(fetch_shared_asset, asset_urls.values())))
+
+    rewritten = []
+    position = 0
+    for start, end, ref in references:
+        filepath = filepaths.get(asset_urls.get(ref))
+        if filepath:
+            rewritten.append(rules[position:start])
+            rewritten.append("../" + zipper.write_file(filepath, os.path.basename(filepath), directory="assets"))
+            position = end
+    rewritten.append(rules[position:])
+    return "".join(rewritten)
+
+
+def find_css_urls(rules):
+    """ Find every url reference (url(...) and @import strings) in a stylesheet
+        Args:
+            rules (str): stylesheet to search
+        Returns list of (start, end, url) for each reference, where start and end
+            are the positions of the url itself in rules ([(int, int, str)])
+        Raises ValueError if the stylesheet has an unterminated comment, string or url(
+    """
+    references = []
+    for match in CSS_TOKEN_RE.finditer(rules):
+        if match.group('error'):
+            raise ValueError("Malformed css at position {}".format(match.start()))
+        group = 'url' if match.group('url') is not None else 'import'
+        ref = match.group(group)
+        if ref is None:
+            continue
+        start, end = match.span(group)
+        if ref[:1] in ('"', "'"):
+            start, end, ref = start + 1, end - 1, ref[1:-1]
+        references.append((start, end, ref))
+    return references
+
+
+def is_css_asset(ref):
+    """ Determine whether a stylesheet reference points to a file to download """
+    return bool(ref) and not ref.startswith(('data:', '#', 'about:'))
+
+
+def fetch_shared_asset(url):
+    """ Download a stylesheet asset to the shared asset directory (if not already there)
+        Args:
+            url (str): url to asset
+        Returns path to asset (str) or None if it couldn't be downloaded
+    """
+    filename = url.split('?')[0].split('/')[-1]
+    filepath = os.path.sep.join([SHARED_ASSET_DIRECTORY, filename])
+    try:
+        if not os.path.isfile(filepath):
+            # Write to a temporary file first so other snack workers never zip a partial asset
+            content = read(url)
+            fd, temp_path = tempfile.mkstemp(dir=SHARED_ASSET_DIRECTORY)
+            with os.fdopen(fd, 'wb') as fobj:
+                fobj.write(content)
+            os.replace(temp_path, filepath)
+        use_cached_file(filepath)
+        return filepath
+    except requests.exceptions.HTTPError:
+        LOGGER.warning("Could not download css url {}".format(url))
+
+
+def rewrite_css_urls_with_cssutils(rules, url, zipper):
+    """ Rewrite urls in a stylesheet the tokenizer can't handle using cssutils
+        Args:
+            rules (str): stylesheet contents
+            url (str): url to css file
+            zipper (html_writer): zip to write to
+        Returns str of css style rules
+    """
+    parser = cssutils.CSSParser(fetcher=lambda import_url: (None, read(import_url).decode('utf-8-sig', errors='replace')))
+    sheet = parser.parseString(rules, href=url)
     rules = sheet.cssText.decode('utf-8')
+    for ref in cssutils.getUrls(sheet):
+        filepath = is_css_asset(ref) and fetch_shared_asset(urljoin(url, ref))
+        if filepath:
+            new_url = zipper.write_file(filepath, os.path.basename(filepath), directory="assets")
+            rules = rules.replace(ref, "../" + new_url)
+    return rules
+
 
-    # Parse urls in css
-    for url in cssutils.getUrls(sheet):
+# Download scheduling
+################################################################################
+class DownloadJob(object):
+    """ A download queued on a `DownloadScheduler` """
+
+    def __init__(self, run, estimate=None):
+        self.run = run              # Function that downloads (and returns the result)
+        self.estimate = estimate    # Function that returns the download's size in bytes (None if unknown)
+        self.size = None            # Estimated size in bytes
+        self.duration = None        # Seconds the download took
+        self.future = None
+
+    def estimate_size(self):
         try:
-            # Download any urls in css to the shared asset directory (if not already there)
-            filename = url.split('?')[0].split('/')[-1]
-            filepath = os.path.sep.join([SHARED_ASSET_DIRECTORY, filename])
-            if not os.path.isfile(filepath):
-                with open(filepath, 'wb') as fobj:
-                    fobj.write(read(url))
+            self.size = self.estimate and self.estimate()
+        except Exception:
+            self.size = None    # Errors are raised again (and logged) by the download itself
 
-            # Replace text with new url
-            new_url = zipper.write_file(filepath, filename, directory="assets")
-            rules = rules.replace(url, "../" + new_url)
+    def execute(self):
+        start = time.time()
+        try:
+            return self.run()
+        finally:
+            self.duration = time.time() - start
 
-        except requests.exceptions.HTTPError:
-            LOGGER.warning("Could not download css url {}".format(url))
+    def result(self):
+        """ Get what the download returned (raising any error it hit) """
+        return self.future.result()
 
-    return rules
+
+class DownloadScheduler(object):
+    """
+    Runs a batch of downloads largest first (longest processing time first) across a fixed
+    number of slots, so the biggest downloads start right away instead of becoming a long tail
+    at the end of the run. Sizes are estimated up front from metadata or HEAD requests, which
+    also predicts when the batch will finish.
+
+    The slots stay up between batches until `close` is called, so batches run from several
+    threads share them and each slot keeps its youtube_dl instance and http session.
+    """
+
+    def __init__(self, name, workers, report=LOGGER.info):
+        self.name = name
+        self.workers = max(workers, 1)
+        self.report = report        # Logging function to report predicted and actual times to
+        self.jobs = []
+        self.lock = threading.Lock()
+        self.executor = None
+        self.executor_pid = None    # Process the slots were started in (forked workers start their own)
+
+    def add(self, run, estimate=None):
+        """ Queue a download
+            Args:
+                run (function): downloads and returns the result
+                estimate (function): returns the download's size in bytes, or None if unknown (optional)
+            Returns DownloadJob to get the result from once the scheduler has run
+        """
+        job = DownloadJob(run, estimate)
+        self.jobs.append(job)
+        return job
+
+    def run(self, jobs=None):
+        """ Estimate every job's size, then run the jobs largest first and wait for them to finish
+            Args:
+                jobs ([DownloadJob]): batch to run instead of the jobs queued with `add` (optional)
+        """
+        jobs = self.jobs if jobs is None else jobs
+        if not jobs:
+            return
+        executor = self.get_executor()
+        list(executor.map(DownloadJob.estimate_size, jobs))
+
+        # Jobs start in the order they're submitted, so submit the largest first (unknown sizes keep their order)
+        jobs = sorted(jobs, key=lambda job: -(job.size or 0))
+        predicted = predict_makespan([job.size or 0 for job in jobs], self.workers, DOWNLOAD_RATE)
+        start = time.time()
+        for job in jobs:
+            job.future = executor.submit(job.execute)
+        wait_for_futures([job.future for job in jobs])
+        actual = time.time() - start
+
+        total = sum(job.size or 0 for job in jobs)
+        busy = sum(job.duration or 0 for job in jobs)
+        self.report("{}: {} downloads ({:.1f} MB) on {} slots took {:.1f}s (predicted {:.1f}s, {:.1f} MB/s per slot)".format(
+            self.name, len(jobs), total / 1024 / 1024, self.workers, actual, predicted,
+            total / busy / 1024 / 1024 if busy else 0))
+
+    def get_executor(self):
+        """ Get the thread pool the slots run on, starting it on first use in this process """
+        with self.lock:
+            if self.executor is None or self.executor_pid != os.getpid():
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+                self.executor_pid = os.getpid()
+            return self.executor
+
+    def close(self):
+        """ Stop the slots once every batch is done (a later batch starts them again) """
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor and self.executor_pid == os.getpid():
+            executor.shutdown()
+
+
+def predict_makespan(sizes, workers, rate):
+    """ Predict when downloads started in order on the first free slot will all be done
+        Args:
+            sizes ([int]): size of each download in bytes, in the order they start
+            workers (int): number of slots downloading at a time
+            rate (float): bytes per second each slot downloads at
+        Returns seconds until the last download finishes (float)
+    """
+    slots = [0.0] * workers
+    for size in sizes:
+        heapq.heappush(slots, heapq.heappop(slots) + size / rate)
+    return max(slots)
+
+
+# Slots for snack assets, videos and split out playlist videos, shared by every snack a process zips
+SNACK_DOWNLOADS = DownloadScheduler("Snack downloads", ASSET_WORKERS, report=LOGGER.debug)
+
+
+def estimate_asset_size(url):
+    """ Estimate an asset's size from the archive or a HEAD request
+        Args:
+            url (str): url to asset
+        Returns size in bytes (int) or None if unknown
+    """
+    # Images are small, so don't spend a request on them
+    if url.split('?')[0].lower().endswith(tuple(IMAGE_EXTENSIONS)):
+        return None
+    if ARCHIVE:
+        return ARCHIVE.get_size(format_url(url))
+    response = get_media_session().head(url, allow_redirects=True, timeout=30)
+    return int(response.headers.get('Content-Length') or 0) or None
+
+
+def estimate_video_size(url, video_id):
+    """ Estimate how many bytes a web video will download, from the size of the format it gets
+        Args:
+            url (str): url to video
+            video_id (str): brightcove or youtube id video is cached under
+        Returns size in bytes (int) or None if unknown
+    """
+    write_to_path = get_video_path(video_id)
+    if os.path.isfile(write_to_path):
+        return 0    # Already downloaded
+    if ARCHIVE and not ARCHIVE.recording:
+        return ARCHIVE.get_size("video:{}".format(url))
+    info, _extracted = get_video_info(url, max_bytes=get_video_budget(write_to_path))
+    return info['filesize']
+
+
+# Transcoding functions
+################################################################################
+def get_transcode_key(settings):
+    """ Get a short key for a set of encode settings to name outputs by
+        Args:
+            settings (dict): ffmpeg settings (see `TRANSCODE_SETTINGS`)
+        Returns key (str)
+    """
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+
+
+def transcode_videos(filepaths, settings):
+    """ Re-encode videos with ffmpeg, running one ffmpeg process per core
+        Args:
+            filepaths ([str]): paths to downloaded videos
+            settings (dict): ffmpeg settings (see `TRANSCODE_SETTINGS`)
+        Returns paths to use for each video, in the same order ([str])
+    """
+    with ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS) as executor:
+        return list(executor.map(functools.partial(transcode_video, settings=settings), filepaths))
+
+
+@track_stage('transcode')
+def transcode_video(filepath, settings):
+    """ Re-encode a video at a lower bitrate, reusing an earlier encode of the same source and settings
+        Args:
+            filepath (str): path to downloaded video
+            settings (dict): ffmpeg settings (see `TRANSCODE_SETTINGS`)
+        Returns path to the smaller of the encode and the original video (str)
+    """
+    md5 = get_checksum(filepath)
+    if not md5:
+        md5 = hash_file(filepath)
+        record_checksum(filepath, md5)
+    write_to_path = os.path.sep.join([TRANSCODE_DIRECTORY, "{}-{}.mp4".format(md5, get_transcode_key(settings))])
+    with file_lock(write_to_path):
+        if not os.path.isfile(write_to_path):
+            part_path = "{}.part".format(write_to_path)
+            command = [
+                "ffmpeg", "-nostdin", "-y", "-loglevel", "error", "-i", filepath,
+                "-vf", "scale=-2:'min({},ih)'".format(settings['height']),
+                "-c:v", "libx264", "-preset", settings['preset'], "-crf", str(settings['crf']),
+                "-pix_fmt", "yuv420p", "-threads", "1",     # Each core runs its own encode
+                "-c:a", "aac", "-b:a", settings['audio_bitrate'],
+                "-movflags", "+faststart", "-f", "mp4", part_path,
+            ]
+            try:
+                with ffmpeg_slot():
+                    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                error = result.returncode and result.stderr.decode('utf-8', 'replace').strip()
+            except OSError as e:    # e.g. ffmpeg isn't installed
+                error = str(e)
+            if error or not verify_video(part_path):
+                if os.path.isfile(part_path):
+                    os.remove(part_path)
+                LOGGER.error("Could not re-encode {} ({})".format(filepath, error or "corrupted output"))
+                return filepath
+            os.replace(part_path, write_to_path)
+            UPLOAD_CHECKSUMS and record_checksum(write_to_path, hash_file(write_to_path))
+
+    use_cached_file(write_to_path)
+    size, encoded_size = os.path.getsize(filepath), os.path.getsize(write_to_path)
+    log_transcode(filepath, size, min(size, encoded_size))
+    return write_to_path if encoded_size < size else filepath
+
+
+@contextlib.contextmanager
+def ffmpeg_slot():
+    """ Hold one of `TRANSCODE_WORKERS` slots to run ffmpeg in, so snack worker processes
+        together never run more encodes than there are cores (no limit where fcntl isn't available)
+    """
+    while fcntl:
+        for slot in range(TRANSCODE_WORKERS):
+            fobj = open(os.path.sep.join([TRANSCODE_DIRECTORY, "slot-{}.lock".format(slot)]), 'a')
+            try:
+                fcntl.flock(fobj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                fobj.close()
+                continue
+            with fobj:      # Released when the file is closed
+                yield
+            return
+        time.sleep(0.5)
+    yield
+
+
+def start_transcode_report():
+    """ Clear the bytes saved by re-encoding that the last run logged """
+    open(TRANSCODE_REPORT_PATH, 'w').close()
+
+
+def log_transcode(filepath, size, encoded_size):
+    """ Log how many bytes re-encoding saved on a video (safe to call from worker processes)
+        Args:
+            filepath (str): path to downloaded video
+            size (int): size of downloaded video in bytes
+            encoded_size (int): size of the video that's used in bytes
+    """
+    LOGGER.info("    Re-encoded {}: {:.1f} MB -> {:.1f} MB".format(
+        os.path.basename(filepath), size / 1024 / 1024, encoded_size / 1024 / 1024))
+    with open(TRANSCODE_REPORT_PATH, 'a') as fobj:
+        fobj.write(json.dumps({"path": filepath, "size": size, "encoded_size": encoded_size}) + "\n")
+
+
+def report_transcoding():
+    """ Log how many bytes re-encoding saved across this run's videos """
+    videos = {}
+    if os.path.isfile(TRANSCODE_REPORT_PATH):
+        with open(TRANSCODE_REPORT_PATH) as fobj:
+            for line in fobj:
+                entry = json.loads(line)
+                videos[entry['path']] = entry
+    size = sum(video['size'] for video in videos.values())
+    saved = size - sum(video['encoded_size'] for video in videos.values())
+    LOGGER.info("Re-encoding saved {:.1f} MB of {:.1f} MB across {} videos".format(
+        saved / 1024 / 1024, size / 1024 / 1024, len(videos)))
+
+
+# Video info functions
+################################################################################
+_worker_local = threading.local()       # Long-lived downloader instances for each worker thread
+_video_info_lock = threading.Lock()
+_video_info = None
+_video_locks = {}
+
+
+def get_youtube_dl():
+    """ Get the YoutubeDL instance for the current worker, creating it on first use
+        Returns youtube_dl.YoutubeDL
+    """
+    if not hasattr(_worker_local, 'ydl'):
+        _worker_local.ydl = youtube_dl.YoutubeDL({"format": VIDEO_FORMAT, "quiet": True, "no_warnings": True})
+    return _worker_local.ydl
+
+
+def get_media_session():
+    """ Get the requests session for the current worker, creating it on first use
+        Returns requests.Session
+    """
+    if not hasattr(_worker_local, 'session'):
+        _worker_local.session = requests.Session()
+    return _worker_local.session
+
+
+def get_video_info_cache():
+    """ Get the persistent cache of extracted video info, loading it on first use
+        Returns dict mapping video urls to info
+    """
+    global _video_info
+    if _video_info is None:
+        _video_info = load_json(VIDEO_INFO_PATH)
+    return _video_info
+
+
+def get_video_info(url, max_bytes=None):
+    """ Get cached info for a web video, extracting it again if missing, expired or over the budget
+        Args:
+            url (str): url to video
+            max_bytes (int): most bytes video may take up (None for no budget)
+        Returns
+            info (dict): cached video info (see `extract_video_info`)
+            extracted (dict): youtube_dl info dict if extraction had to run, otherwise None
+    """
+    with _video_info_lock:
+        info = get_video_info_cache().get(url)
+    if info and info['expires'] > time.time() + 60:     # Leave time to start the transfer
+        # A format picked for another budget can still be used if it fits this one
+        fits = max_bytes is not None and info.get('filesize') is not None and info['filesize'] <= max_bytes
+        if fits or info.get('max_bytes') == max_bytes:
+            return info, None
+    return extract_video_info(url, max_bytes=max_bytes)
+
+
+def extract_video_info(url, max_bytes=None):
+    """ Run extraction and format selection for a web video and cache the result
+        Args:
+            url (str): url to video
+            max_bytes (int): most bytes video may take up (None for no budget)
+        Returns
+            info (dict): chosen format, direct media url (if any), bitrate, size and expiry
+            extracted (dict): youtube_dl info dict with the selected format(s)
+    """
+    # Formats are only listed here (and archived as listed) so they can be picked to fit the budget
+    ydl = get_youtube_dl()
+    listed = json.loads(fetch_archived("youtube-dl:{}".format(url), lambda: json.dumps(
+        ydl.extract_info(url, download=False, process=False)).encode('utf-8')).decode('utf-8'))
+    ydl.params['format'] = VIDEO_FORMAT
+    estimated_size = None
+    if listed.get('formats'):
+        ydl.params['format'], estimated_size = select_video_format(listed['formats'], listed.get('duration'), max_bytes)
+    if max_bytes is not None and estimated_size is None:
+        LOGGER.warning("Sizes of {} are unknown, so its {:.1f} MB budget can't be applied".format(
+            url, max_bytes / 1024 / 1024))
+    extracted = ydl.process_ie_result(dict(listed, requested_formats=None), download=False)
+
+    selected_formats = extracted.get('requested_formats') or [extracted]
+    direct = len(selected_formats) == 1 and extracted.get('protocol') in ('http', 'https')
+    info = {
+        "id": extracted.get('id'),
+        "format_id": extracted.get('format_id'),
+        "ext": extracted.get('ext'),
+        "url": extracted['url'] if direct else None,     # Formats that need merging go through youtube_dl
+        "http_headers": extracted.get('http_headers') or {},
+        "height": extracted.get('height'),
+        "tbr": sum(f.get('tbr') or 0 for f in selected_formats) or None,
+        "filesize": estimate_format_size(selected_formats, extracted.get('duration')) or estimated_size,
+        "max_bytes": max_bytes,
+        "expires": get_url_expiry(selected_formats[0].get('url') or ""),
+    }
+    with _video_info_lock:
+        update_json(VIDEO_INFO_PATH, get_video_info_cache(), url, info)
+    return info, extracted
+
+
+def select_video_format(formats, duration=None, max_bytes=None):
+    """ Pick the best format that fits a byte budget, preferring pre-muxed mp4s (no merge step)
+        and then direct downloads (which can be resumed)
+        Args:
+            formats ([dict]): formats listed for video by youtube_dl
+            duration (float): length of video in seconds, to estimate sizes from bitrates (optional)
+            max_bytes (int): most bytes video may take up (None for no budget)
+        Returns
+            format (str): youtube_dl format spec (e.g. "18" or "137+140")
+            size (int): estimated size of format (None if unknown)
+    """
+    # Formats without a height are left out, as they were by the `height<=480` format spec
+    videos = [f for f in formats if f.get('vcodec') != 'none' and f.get('height') and f['height'] <= MAX_VIDEO_HEIGHT]
+    audio = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') != 'none' and f.get('ext') == 'm4a']
+    muxed = [[f] for f in videos if f.get('acodec') != 'none' and f.get('ext') == 'mp4']
+    merged = [[v, a] for v in videos if v.get('acodec') == 'none' and v.get('ext') == 'mp4' for a in audio]
+
+    def rank(candidate):
+        direct = len(candidate) == 1 and candidate[0].get('protocol', 'https') in ('http', 'https')
+        return direct, candidate[0].get('height') or 0, sum(f.get('tbr') or 0 for f in candidate)
+
+    for candidates in (muxed, merged):
+        sizes = [estimate_format_size(candidate, duration) for candidate in candidates]
+        fitting = [(candidate, size) for candidate, size in zip(candidates, sizes)
+                   if max_bytes is None or (size is not None and size <= max_bytes)]
+        if fitting:
+            candidate, size = max(fitting, key=lambda item: rank(item[0]))
+            return "+".join(f['format_id'] for f in candidate), size
+
+    # Nothing fits, so go as small as possible (the caller warns about the overrun)
+    sized = [(size, candidate) for candidate in muxed + merged
+             for size in [estimate_format_size(candidate, duration)] if size is not None]
+    if sized:
+        size, candidate = min(sized, key=lambda item: item[0])
+        return "+".join(f['format_id'] for f in candidate), size
+    return VIDEO_FORMAT, None
+
+
+def estimate_format_size(formats, duration=None):
+    """ Estimate how many bytes a download takes up from its sizes, or bitrates and duration
+        Args:
+            formats ([dict]): formats that are downloaded together
+            duration (float): length of video in seconds (optional)
+        Returns size in bytes (int) or None if any format's size is unknown
+    """
+    total = 0
+    for f in formats:
+        size = f.get('filesize') or f.get('filesize_approx')
+        if not size and f.get('tbr') and duration:
+            size = f['tbr'] * 1000 / 8 * duration     # tbr is in kbit/s
+        if not size:
+            return None
+        total += int(size)
+    return total
+
+
+def start_video_budget(video_budget=None, channel_budget=None):
+    """ Set the byte budgets for this run's videos and clear what the last run spent
+        Args:
+            video_budget (int): most bytes each video may take up (None for no budget)
+            channel_budget (int): most bytes all videos together may take up (None for no budget)
+    """
+    with file_lock(VIDEO_BUDGET_PATH):
+        save_json(VIDEO_BUDGET_PATH, {"video_budget": video_budget, "channel_budget": channel_budget, "videos": {}})
+
+
+def get_video_budget(write_to_path):
+    """ Get how many bytes a video may take up, given what the other videos in the channel take up
+        Args:
+            write_to_path (str): where video is written to
+        Returns most bytes video may take up (int) or None if there's no budget
+    """
+    return get_budget_left(load_json(VIDEO_BUDGET_PATH), write_to_path)
+
+
+def get_budget_left(budget, write_to_path):
+    """ Get how many bytes a video may take up from the budget ledger
+        Args:
+            budget (dict): budget ledger (see `start_video_budget`)
+            write_to_path (str): where video is written to
+        Returns most bytes video may take up (int) or None if there's no budget
+    """
+    limits = [budget.get('video_budget')]
+    if budget.get('channel_budget') is not None:
+        key = os.path.basename(write_to_path)
+        spent = sum(size for video, size in budget.get('videos', {}).items() if video != key)
+        limits.append(max(budget['channel_budget'] - spent, 0))
+    limits = [limit for limit in limits if limit is not None]
+    return min(limits) if limits else None
+
+
+def reserve_video_budget(write_to_path, size, max_bytes):
+    """ Reserve bytes for a video, checking the budget it was picked for under the same lock
+        Args:
+            write_to_path (str): where video is written to
+            size (int): expected size of video in bytes
+            max_bytes (int): budget the video's format was picked for (None for no budget)
+        Returns None if the bytes were reserved, otherwise the smaller budget the video has
+            left now that other videos have reserved theirs (int)
+    """
+    with file_lock(VIDEO_BUDGET_PATH):
+        budget = load_json(VIDEO_BUDGET_PATH)
+        budget_left = get_budget_left(budget, write_to_path)
+        if budget_left is not None and size > budget_left and (max_bytes is None or budget_left < max_bytes):
+            return budget_left
+        budget.setdefault('videos', {})[os.path.basename(write_to_path)] = size
+        save_json(VIDEO_BUDGET_PATH, budget)
+
+
+def charge_reused_videos(videos, embedded=None):
+    """ Charge videos reused from an earlier run against this run's budget
+        Args:
+            videos ([dict]): video records with a `path` key
+            embedded (dict): filenames of videos embedded in reused snack zips -> size in zip (optional)
+    """
+    sizes = dict(embedded or {})
+    sizes.update({os.path.basename(video['path']): os.path.getsize(video['path']) for video in videos})
+    if not sizes:
+        return
+    with file_lock(VIDEO_BUDGET_PATH):
+        budget = load_json(VIDEO_BUDGET_PATH)
+        budget.setdefault('videos', {}).update(sizes)
+        save_json(VIDEO_BUDGET_PATH, budget)
+
+
+def charge_video_budget(write_to_path, size):
+    """ Record how many bytes a video takes up (or is expected to) against the channel budget
+        Args:
+            write_to_path (str): where video is written to
+            size (int): size of video in bytes
+    """
+    with file_lock(VIDEO_BUDGET_PATH):
+        budget = load_json(VIDEO_BUDGET_PATH)
+        budget.setdefault('videos', {})[os.path.basename(write_to_path)] = size
+        save_json(VIDEO_BUDGET_PATH, budget)
+
+
+def report_video_budget():
+    """ Log how many bytes this run's videos take up against the channel budget """
+    budget = load_json(VIDEO_BUDGET_PATH)
+    spent = sum(budget.get('videos', {}).values())
+    LOGGER.info("Videos: {:.1f} MB in {} files{}".format(
+        spent / 1024 / 1024, len(budget.get('videos', {})),
+        "" if budget.get('channel_budget') is None else
+        " ({:.1f} MB channel budget)".format(budget['channel_budget'] / 1024 / 1024)))
+
+
+def clear_video_info(url):
+    """ Remove a web video from the info cache
+        Args:
+            url (str): url to video
+    """
+    with _video_info_lock:
+        if url in get_video_info_cache():
+            update_json(VIDEO_INFO_PATH, get_video_info_cache(), url, None)
+
+
+def get_url_expiry(media_url):
+    """ Determine when a signed media url expires
+        Args:
+            media_url (str): direct url to media file
+        Returns timestamp the url expires at (float)
+    """
+    query = parse_qs(urlparse(media_url).query)
+    for key in ('expire', 'Expires', 'expires'):
+        if query.get(key) and query[key][0].isdigit():
+            return float(query[key][0])
+    return time.time() + VIDEO_INFO_TTL
+
+
+def load_json(path):
+    """ Load json data from a file
+        Args:
+            path (str): path to json file
+        Returns data from file, or an empty dict if the file doesn't exist (dict)
+    """
+    if os.path.isfile(path):
+        try:
+            with open(path) as fobj:
+                return json.load(fobj)
+        except ValueError:
+            LOGGER.warning("Ignoring corrupted file {}".format(path))
+    return {}
+
+
+def update_json(path, data, key, value):
+    """ Set one key of a json file that other processes may also be updating
+        Args:
+            path (str): path to json file
+            data (dict): in-memory copy of the file, refreshed with the other processes' changes
+            key (str): key to set
+            value: value to set (None to remove key)
+    """
+    with file_lock(path):
+        latest = load_json(path)
+        if value is None:
+            latest.pop(key, None)
+        else:
+            latest[key] = value
+        save_json(path, latest)
+    data.clear()
+    data.update(latest)
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """ Hold an exclusive lock for path across processes (a no-op where fcntl isn't available)
+        Args:
+            path (str): path to lock
+    """
+    with open("{}.lock".format(path), 'a') as fobj:
+        if fcntl:
+            fcntl.flock(fobj, fcntl.LOCK_EX)    # Released when the file is closed
+        yield
+
+
+def save_json(path, data):
+    """ Atomically write json data to a file
+        Args:
+            path (str): path to json file
+            data (dict): data to write
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, 'w') as fobj:
+        json.dump(data, fobj, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+# Checksum functions
+################################################################################
+# ricecooker 0.7+ hashes every file in its own pipeline, so recording checksums for uploads only pays off
+# on 0.6 (transcoding still records the checksums it names its encodes by)
+UPLOAD_CHECKSUMS = not hasattr(config, "FILE_PIPELINE")
+_checksum_lock = threading.Lock()
+_checksums = {}         # Path -> {size, mtime, md5} recorded when the file was written
+_checksums_read = 0     # How many bytes of the checksum index have been loaded
+
+
+def hash_file(filepath, file_hash=None):
+    """ Hash a file's contents
+        Args:
+            filepath (str): path to file
+            file_hash (hashlib hash): hash to update (optional, defaults to a new md5)
+        Returns md5 hex digest (str)
+    """
+    file_hash = file_hash or hashlib.md5()
+    with open(filepath, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(MEDIA_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def record_checksum(filepath, md5):
+    """ Append a file's checksum to the checksum index (safe to call from worker processes)
+        Args:
+            filepath (str): path to file
+            md5 (str): md5 hex digest of file
+    """
+    stat = os.stat(filepath)
+    entry = {"path": os.path.realpath(filepath), "size": stat.st_size, "mtime": stat.st_mtime_ns, "md5": md5}
+    with _checksum_lock:
+        _checksums[entry['path']] = entry
+        with open(CHECKSUM_INDEX_PATH, 'a') as fobj:
+            fobj.write(json.dumps(entry) + "\n")
+
+
+def start_checksum_index():
+    """ Compact the checksum index to one line per file that still exists and hasn't changed """
+    global _checksums_read
+    entries = {}
+    if os.path.isfile(CHECKSUM_INDEX_PATH):
+        with open(CHECKSUM_INDEX_PATH) as fobj:
+            for line in fobj:
+                if line.endswith("\n"):    # Skip a line another process is still writing
+                    entry = json.loads(line)
+                    entries[entry['path']] = entry
+    for path, entry in list(entries.items()):
+        stat = os.path.isfile(path) and os.stat(path)
+        if not stat or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+            del entries[path]
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(CHECKSUM_INDEX_PATH), suffix=".tmp")
+    with os.fdopen(fd, 'w') as fobj:
+        for _path, entry in sorted(entries.items()):
+            fobj.write(json.dumps(entry) + "\n")
+    with _checksum_lock:
+        os.replace(temp_path, CHECKSUM_INDEX_PATH)
+        _checksums.clear()
+        _checksums.update(entries)
+        _checksums_read = os.path.getsize(CHECKSUM_INDEX_PATH)
+
+
+def get_checksum(filepath):
+    """ Look up the checksum recorded for a file, if the file hasn't changed since
+        Args:
+            filepath (str): path to file
+        Returns md5 hex digest (str) or None if there is no up to date checksum
+    """
+    global _checksums_read
+    path = os.path.realpath(filepath)
+    stat = os.stat(path)
+    with _checksum_lock:
+        # Pick up checksums other processes have appended since the index was last read
+        if path not in _checksums and os.path.isfile(CHECKSUM_INDEX_PATH):
+            with open(CHECKSUM_INDEX_PATH, 'rb') as fobj:
+                if os.fstat(fobj.fileno()).st_size < _checksums_read:
+                    _checksums_read = 0     # Compacted by another run since it was last read
+                fobj.seek(_checksums_read)
+                for line in fobj:
+                    if not line.endswith(b"\n"):    # Skip a line another process is still writing
+                        break
+                    entry = json.loads(line.decode('utf-8'))
+                    _checksums[entry['path']] = entry
+                    _checksums_read += len(line)
+        entry = _checksums.get(path)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+        return entry['md5']
+
+
+class ChecksummedFileMixin(object):
+    """
+    Uses the checksum recorded while scraping instead of letting ricecooker hash the file
+    again: the file is copied straight into ricecooker's storage under its hashed name
+    (or not at all if it's already there).
+
+    Only done on ricecooker versions that download files themselves (before 0.7). Newer
+    versions run every file through a pipeline that also sets the preset and duration and
+    caches its own results, so the file is handed to it unchanged.
+    """
+
+    def process_file(self):
+        md5 = os.path.isfile(self.path) and get_checksum(self.path)
+        if not md5 or not self.can_use_checksum():
+            return super(ChecksummedFileMixin, self).process_file()
+
+        try:
+            self.validate()
+            extension = os.path.splitext(self.path)[1][1:].lower() or self.default_ext
+            self.filename = "{}.{}".format(md5, extension)
+            storage_path = config.get_storage_path(self.filename)
+            if not os.path.isfile(storage_path):
+                shutil.copyfile(self.path, storage_path)
+            return self.filename
+        except (AssertionError, IOError) as err:
+            self.filename = None
+            self.error = err
+            config.FAILED_FILES.append(self)
+
+    def can_use_checksum(self):
+        return UPLOAD_CHECKSUMS
+
+
+class ChecksummedHTMLZipFile(ChecksummedFileMixin, files.HTMLZipFile):
+    pass
+
+
+class ChecksummedVideoFile(ChecksummedFileMixin, files.VideoFile):
+
+    def can_use_checksum(self):
+        # Videos that ricecooker will compress still need to go through its own processing
+        return super(ChecksummedVideoFile, self).can_use_checksum() \
+            and not (getattr(self, "ffmpeg_settings", None) or config.COMPRESS)
+
+
+# Media cache functions
+################################################################################
+_cache_lock = threading.Lock()
+_cache_used = set()     # Paths this process has already logged as used this run
+
+
+def parse_size(value):
+    """ Parse a size given on the command line
+        Args:
+            value (str): number of bytes, optionally with a K, M or G suffix (e.g. 20G)
+        Returns number of bytes (int)
+    """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def use_cached_file(filepath):
+    """ Log that this run uses a cached snack, asset or video (safe to call from worker processes)
+        Args:
+            filepath (str): path to file
+    """
+    path = os.path.realpath(filepath)
+    with _cache_lock:
+        if path in _cache_used:
+            return
+        _cache_used.add(path)
+        with open(CACHE_USAGE_PATH, 'a') as fobj:
+            fobj.write(json.dumps({"path": path}) + "\n")
+
+
+def load_cache_usage():
+    """ Read the cache usage log
+        Returns
+            usage (dict): path -> number of the last run that used it
+            run (int): number of the run the paths logged since the last compaction belong to
+    """
+    usage = {}
+    pending = []        # Paths logged by the current run (or one that was interrupted)
+    if os.path.isfile(CACHE_USAGE_PATH):
+        with open(CACHE_USAGE_PATH) as fobj:
+            for line in fobj:
+                if not line.endswith("\n"):    # Skip a line another process is still writing
+                    continue
+                entry = json.loads(line)
+                if 'run' in entry:
+                    usage[entry['path']] = entry['run']
+                else:
+                    pending.append(entry['path'])
+    run = max(usage.values(), default=0) + 1
+    for path in pending:
+        usage[path] = run
+    return usage, run
+
+
+def save_cache_usage(usage):
+    """ Compact the cache usage log to one line per path
+        Args:
+            usage (dict): path -> number of the last run that used it
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(CACHE_USAGE_PATH), suffix=".tmp")
+    with os.fdopen(fd, 'w') as fobj:
+        for path, run in sorted(usage.items()):
+            fobj.write(json.dumps({"path": path, "run": run}) + "\n")
+    os.replace(temp_path, CACHE_USAGE_PATH)
+
+
+def start_cache_run():
+    """ Start logging which cached files this run uses (files an interrupted run used count as one run) """
+    usage, _run = load_cache_usage()
+    save_cache_usage(usage)
+    with _cache_lock:
+        _cache_used.clear()
+
+
+def get_cached_files():
+    """ List the snacks, shared assets and videos on disk (not the metadata kept alongside them)
+        Returns list of (path, size) tuples
+    """
+    skipped = {os.path.realpath(path) for path in (VIDEO_INFO_PATH, VIDEO_BUDGET_PATH, TRANSCODE_REPORT_PATH)}
+    cached = []
+    for directory in (SNACK_DIRECTORY, VIDEO_DIRECTORY):    # Shared assets are under the snack directory
+        for root, _dirs, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.realpath(os.path.join(root, filename))
+                if path not in skipped and not filename.endswith(".lock"):
+                    cached.append((path, os.path.getsize(path)))
+    return cached
+
+
+def trim_media_cache(max_size=None):
+    """ Evict the files least recently used by a run until the cache fits in max_size,
+        and report how much space is taken up by files this run didn't use
+        Args:
+            max_size (int): most bytes the cache may take up (None to only report)
+    """
+    usage, run = load_cache_usage()
+    cached = [(usage.get(path, 0), path, size) for path, size in get_cached_files()]
+    total = sum(size for _last_run, _path, size in cached)
+    reclaimable = sum(size for last_run, _path, size in cached if last_run < run)
+
+    evicted = []
+    for last_run, path, size in sorted(cached, key=lambda item: (item[0], -item[2])):     # Oldest, then largest first
+        if max_size is None or total <= max_size or last_run >= run:
+            break
+        os.remove(path)
+        if os.path.isfile("{}.lock".format(path)):
+            os.remove("{}.lock".format(path))
+        total -= size
+        evicted.append(size)
+
+    save_cache_usage({path: last_run for last_run, path, _size in cached if os.path.isfile(path) and last_run})
+    LOGGER.info("Media cache: {:.1f} MB in {} files, {:.1f} MB reclaimable (not used this run)".format(
+        total / 1024 / 1024, len(cached) - len(evicted), (reclaimable - sum(evicted)) / 1024 / 1024))
+    if evicted:
+        LOGGER.info("    Evicted {} least recently used files ({:.1f} MB)".format(len(evicted), sum(evicted) / 1024 / 1024))
+    if max_size is not None and total > max_size:
+        LOGGER.warning("Media cache is over its {:.1f} MB cap with files this run used".format(max_size / 1024 / 1024))
+
+
+# Record/replay archive
+################################################################################
+ARCHIVE = None  # HttpArchive that fetches go through (None to always use the network)
+
+
+class HttpArchive(object):
+    """
+    Compact WARC-style archive of every fetch made while scraping. Records are appended as a
+    json header line followed by the (possibly deflated) body:
+        {"key": "https://...", "status": 200, "length": 1234, "encoding": "deflate", "size": 5678}\n<body>\n
+    where `length` is the stored length of the body and `size` its length once inflated.
+    The offset of each body is kept in an index (<archive>.idx), so replay seeks straight to
+    a record instead of scanning the archive. The index is rebuilt from the headers if missing.
+    """
+
+    def __init__(self, path, recording):
+        self.path = path
+        self.index_path = "{}.idx".format(path)
+        self.recording = recording
+        self.lock = threading.Lock()
+        self.index = {}             # Key -> [body offset, body length, status, encoding, inflated size]
+        self.fetching = {}          # Key -> lock held while the key is fetched and recorded
+        if recording:
+            self.fobj = open(path, 'w+b')   # Each recording captures one full run
+        else:
+            self.fobj = open(path, 'rb')
+            self.index = self.load_index()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def load_index(self):
+        """ Load the index, rebuilding it from record headers if it's missing or stale
+            Returns dict mapping keys to [body offset, body length, status, encoding, inflated size]
+        """
+        index = load_json(self.index_path)
+        if index.get('size') == os.path.getsize(self.path):
+            return index['records']
+
+        LOGGER.info("Rebuilding archive index for {}".format(self.path))
+        records = {}
+        self.fobj.seek(0)
+        for line in iter(self.fobj.readline, b""):
+            header = json.loads(line.decode('utf-8'))
+            offset = self.fobj.tell()
+            records[header['key']] = [offset, header['length'], header['status'], header.get('encoding'),
+                                      header.get('size', header['length'])]
+            self.fobj.seek(offset + header['length'] + 1)
+        return records
+
+    def close(self):
+        self.fobj.close()
+        if self.recording:
+            save_json(self.index_path, {"size": os.path.getsize(self.path), "records": self.index})
+
+    def fetch(self, key, fetch):
+        """ Fetch key from the archive when replaying, or with fetch when recording (unless it was
+            already recorded)
+            Args:
+                key (str): url (or other identifier) being fetched
+                fetch (function): returns the contents from the network (bytes)
+            Returns contents (bytes)
+        """
+        if not self.recording:
+            return self.get(key)
+        # Threads fetching the same key wait for the first one to record it
+        with self.lock:
+            key_lock = self.fetching.setdefault(key, threading.Lock())
+        with key_lock:
+            if key in self.index:
+                # Fetched earlier in this recording: serve it from the archive rather than appending it again
+                with self.lock:
+                    self.fobj.flush()
+                return self.get(key)
+            try:
+                content = fetch()
+            except requests.exceptions.HTTPError as e:
+                # Record failures too, so replay fails in the same places
+                self.put(key, b"", status=e.response.status_code if e.response is not None else 500)
+                raise
+            self.put(key, content)
+            return content
+
+    def get(self, key):
+        """ Read a record's body
+            Args:
+                key (str): key record was stored under
+            Returns record body (bytes)
+        """
+        offset, length, status, encoding = self.lookup(key)
+        content = self.read_at(offset, length)
+        if status >= 400:
+            raise requests.exceptions.HTTPError("{} Error (replayed) for url: {}".format(status, key))
+        return zlib.decompress(content) if encoding == 'deflate' else content
+
+    def put(self, key, content, status=200):
+        """ Append a record, deflating it if that makes it smaller
+            Args:
+                key (str): key to store record under
+                content (bytes): record body
+                status (int): http status of the fetch
+        """
+        encoding, size = None, len(content)
+        compressed = zlib.compress(content)
+        if len(compressed) < len(content):
+            content, encoding = compressed, 'deflate'
+        with self.lock:
+            self.write_header(key, len(content), status, encoding, size)
+            self.fobj.write(content)
+            self.fobj.write(b"\n")
+
+    def put_file(self, key, filepath):
+        """ Append a record with the contents of a (large) file, streaming it in chunks
+            Args:
+                key (str): key to store record under
+                filepath (str): path to file
+        """
+        with self.lock, open(filepath, 'rb') as fobj:
+            self.write_header(key, os.path.getsize(filepath), 200, None, os.path.getsize(filepath))
+            for chunk in iter(lambda: fobj.read(MEDIA_CHUNK_SIZE), b""):
+                self.fobj.write(chunk)
+            self.fobj.write(b"\n")
+
+    def get_file(self, key, write_to_path):
+        """ Write a record stored with `put_file` to a file, streaming it in chunks
+            Args:
+                key (str): key record was stored under
+                write_to_path (str): where to write file to
+        """
+        offset, length, _status, _encoding = self.lookup(key)
+        part_path = "{}.part".format(write_to_path)
+        with open(part_path, 'wb') as fobj:
+            for start in range(offset, offset + length, MEDIA_CHUNK_SIZE):
+                fobj.write(self.read_at(start, min(MEDIA_CHUNK_SIZE, offset + length - start)))
+        os.replace(part_path, write_to_path)
+
+    def lookup(self, key):
+        """ Get a record's body offset, body length, status and encoding """
+        if key not in self.index:
+            raise requests.exceptions.ConnectionError("{} is not in archive {}".format(key, self.path))
+        return self.index[key][:4]
+
+    def get_size(self, key):
+        """ Get how many bytes a record's body inflates to (None if key isn't in the archive) """
+        record = self.index.get(key)
+        return record and (record[4] if len(record) > 4 else record[1])
+
+    def read_at(self, offset, length):
+        """ Read bytes without moving a shared file position (safe across threads and forked workers) """
+        if hasattr(os, 'pread'):
+            return os.pread(self.fobj.fileno(), length, offset)
+        with self.lock:
+            self.fobj.seek(offset)
+            content = self.fobj.read(length)
+            self.fobj.seek(0, os.SEEK_END)     # Keep appending at the end while recording
+            return content
+
+    def write_header(self, key, length, status, encoding, size):
+        header = {"key": key, "length": length, "status": status, "encoding": encoding, "size": size}
+        self.fobj.write(json.dumps(header).encode('utf-8') + b"\n")
+        self.index[key] = [self.fobj.tell(), length, status, encoding, size]
+
+
+def open_archive(path, recording):
+    """ Route fetches through an archive for the rest of the run
+        Args:
+            path (str): path to archive file
+            recording (bool): True to record fetches to the archive, False to replay them from it
+    """
+    global ARCHIVE
+    ARCHIVE = HttpArchive(path, recording)
+    LOGGER.info("{} fetches {} {}".format("Recording" if recording else "Replaying", "to" if recording else "from", path))
+
+
+def close_archive():
+    """ Close the archive (if one is open), writing its index when recording """
+    global ARCHIVE
+    if ARCHIVE:
+        ARCHIVE.close()
+        ARCHIVE = None
+
+
+def fetch_archived(key, fetch):
+    """ Fetch through the archive (if one is open)
+        Args:
+            key (str): url (or other identifier) being fetched
+            fetch (function): returns the contents from the network (bytes)
+        Returns contents (bytes)
+    """
+    if ARCHIVE:
+        return ARCHIVE.fetch(key, fetch)
+    return fetch()
 
 
 # CLI